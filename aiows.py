@@ -0,0 +1,304 @@
+import asyncio
+import base64
+import hashlib
+import ipaddress
+import os
+import socket
+import ssl
+import struct
+from urllib.parse import urlparse
+
+# minimal RFC 6455 websocket on top of asyncio streams, just enough for the game protocol:
+# binary/text messages, ping/pong and close. used by territorialbot.AsyncClient and local servers
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+class ConnectionClosed(Exception):
+    pass
+
+class HandshakeError(Exception):
+    pass
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + GUID).encode()).digest()).decode()
+
+def apply_mask(mask, payload):
+    length = len(payload)
+    if length == 0:
+        return b""
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+def encode_frame(opcode, payload, mask):
+    length = len(payload)
+    head = 0x80 | opcode
+    mask_bit = 0x80 if mask else 0
+
+    if length < 126:
+        header = struct.pack("!BB", head, mask_bit | length)
+    elif length < 65536:
+        header = struct.pack("!BBH", head, mask_bit | 126, length)
+    else:
+        header = struct.pack("!BBQ", head, mask_bit | 127, length)
+
+    if mask:
+        key = os.urandom(4)
+        return header + key + apply_mask(key, payload)
+    return header + bytes(payload)
+
+class WebSocket:
+    def __init__(self, reader, writer, is_client, path="/"):
+        self.reader = reader
+        self.writer = writer
+        self.is_client = is_client
+        self.path = path
+        self.closed = False
+
+    # writes are buffered by the transport, so sending never blocks the event loop
+    def send_binary(self, data):
+        if self.closed:
+            raise ConnectionClosed()
+        self.writer.write(encode_frame(OPCODE_BINARY, data, self.is_client))
+
+    # frame built beforehand with encode_frame, used to send one frame to many connections
+    def send_raw(self, frame):
+        if self.closed:
+            raise ConnectionClosed()
+        self.writer.write(frame)
+
+    def send_text(self, text):
+        if self.closed:
+            raise ConnectionClosed()
+        self.writer.write(encode_frame(OPCODE_TEXT, text.encode(), self.is_client))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def read_frame(self):
+        head, second = await self.reader.readexactly(2)
+        opcode = head & 0x0F
+        fin = head & 0x80
+        length = second & 0x7F
+
+        if length == 126:
+            length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+
+        if second & 0x80:
+            key = await self.reader.readexactly(4)
+            payload = apply_mask(key, await self.reader.readexactly(length))
+        else:
+            payload = await self.reader.readexactly(length)
+
+        return fin, opcode, payload
+
+    async def recv(self):
+        message_opcode = None
+        chunks = []
+
+        while True:
+            try:
+                fin, opcode, payload = await self.read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.abort()
+                raise ConnectionClosed()
+
+            if opcode == OPCODE_PING:
+                if not self.closed:
+                    self.writer.write(encode_frame(OPCODE_PONG, payload, self.is_client))
+                continue
+            elif opcode == OPCODE_PONG:
+                continue
+            elif opcode == OPCODE_CLOSE:
+                self.close(payload[:2])
+                raise ConnectionClosed()
+
+            if opcode != OPCODE_CONTINUATION:
+                message_opcode = opcode
+            chunks.append(payload)
+
+            if fin:
+                data = b"".join(chunks) if len(chunks) > 1 else chunks[0]
+                if message_opcode == OPCODE_TEXT:
+                    return data.decode("utf-8", "replace")
+                return data
+
+    def close(self, code=b"\x03\xe8"):
+        if self.closed:
+            return
+        try:
+            self.writer.write(encode_frame(OPCODE_CLOSE, code, self.is_client))
+        except Exception:
+            pass
+        self.abort()
+
+    def abort(self):
+        self.closed = True
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+async def read_headers(reader):
+    raw = await reader.readuntil(b"\r\n\r\n")
+    lines = raw.decode("latin-1").split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+PROXY_TYPES = ("http", "socks4", "socks4a", "socks5", "socks5h")
+
+# same proxy types as websocket-client, without authentication. socks4 and socks5 resolve
+# the host here, socks4a and socks5h leave it to the proxy
+async def open_tunnel(proxy_options, host, port, timeout):
+    proxy_type, proxy_host, proxy_port = proxy_options[:3]
+    if proxy_type not in PROXY_TYPES:
+        raise HandshakeError(f"unsupported proxy type: {proxy_type}")
+
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(proxy_host, proxy_port), timeout)
+    try:
+        if proxy_type == "http":
+            await asyncio.wait_for(http_tunnel(reader, writer, host, port), timeout)
+        elif proxy_type in ("socks4", "socks4a"):
+            await asyncio.wait_for(socks4_tunnel(reader, writer, host, port, proxy_type == "socks4a"), timeout)
+        else:
+            await asyncio.wait_for(socks5_tunnel(reader, writer, host, port, proxy_type == "socks5h"), timeout)
+    except Exception:
+        writer.close()
+        raise
+    return reader, writer
+
+async def http_tunnel(reader, writer, host, port):
+    writer.write(f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode())
+    status, _ = await read_headers(reader)
+    if " 200" not in status:
+        raise HandshakeError(f"proxy refused tunnel: {status}")
+
+async def resolve(host, port, family=socket.AF_UNSPEC):
+    try:
+        return ipaddress.ip_address(host)
+    except ValueError:
+        pass
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, family=family, type=socket.SOCK_STREAM)
+    return ipaddress.ip_address(infos[0][4][0])
+
+async def socks4_tunnel(reader, writer, host, port, remote_dns):
+    if remote_dns:
+        # 0.0.0.1 asks the proxy to resolve the name after the empty user id
+        request = struct.pack("!BBH", 4, 1, port) + bytes((0, 0, 0, 1)) + b"\x00" + host.encode("idna") + b"\x00"
+    else:
+        address = await resolve(host, port, socket.AF_INET)
+        request = struct.pack("!BBH", 4, 1, port) + address.packed + b"\x00"
+    writer.write(request)
+    reply = await reader.readexactly(8)
+    if reply[1] != 0x5A:
+        raise HandshakeError(f"socks4 proxy refused tunnel: {reply[1]}")
+
+async def socks5_tunnel(reader, writer, host, port, remote_dns):
+    writer.write(b"\x05\x01\x00")
+    method = await reader.readexactly(2)
+    if method != b"\x05\x00":
+        raise HandshakeError("socks5 proxy wants authentication")
+
+    if remote_dns:
+        name = host.encode("idna")
+        target = bytes((3, len(name))) + name
+    else:
+        address = await resolve(host, port)
+        target = bytes((1 if address.version == 4 else 4,)) + address.packed
+    writer.write(b"\x05\x01\x00" + target + struct.pack("!H", port))
+
+    version, status, _, kind = await reader.readexactly(4)
+    if status != 0:
+        raise HandshakeError(f"socks5 proxy refused tunnel: {status}")
+    # bound address, not needed
+    if kind == 1:
+        await reader.readexactly(4 + 2)
+    elif kind == 4:
+        await reader.readexactly(16 + 2)
+    else:
+        await reader.readexactly((await reader.readexactly(1))[0] + 2)
+
+async def connect(url, ssl_context=None, proxy_options=None, timeout=10):
+    parsed = urlparse(url)
+    secure = parsed.scheme == "wss"
+    host = parsed.hostname
+    port = parsed.port or (443 if secure else 80)
+    path = parsed.path or "/"
+    if parsed.query:
+        path += "?" + parsed.query
+
+    if secure and ssl_context == None:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    if proxy_options != None:
+        reader, writer = await open_tunnel(proxy_options, host, port, timeout)
+        if secure:
+            await writer.start_tls(ssl_context, server_hostname=host)
+    else:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context if secure else None, server_hostname=host if secure else None),
+            timeout
+        )
+
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((
+        f"GET {path} HTTP/1.1\r\n"
+        f"Host: {host}:{port}\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        f"Sec-WebSocket-Key: {key}\r\n"
+        "Sec-WebSocket-Version: 13\r\n\r\n"
+    ).encode())
+
+    try:
+        status, headers = await asyncio.wait_for(read_headers(reader), timeout)
+    except Exception:
+        writer.close()
+        raise
+
+    if " 101" not in status or headers.get("sec-websocket-accept") != accept_key(key):
+        writer.close()
+        raise HandshakeError(f"handshake failed: {status}")
+
+    return WebSocket(reader, writer, True, path)
+
+async def serve(handler, host="127.0.0.1", port=0, ssl_context=None, backlog=4096):
+    async def on_connection(reader, writer):
+        try:
+            request, headers = await read_headers(reader)
+            key = headers["sec-websocket-key"]
+        except Exception:
+            writer.close()
+            return
+
+        writer.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept_key(key)}\r\n\r\n"
+        ).encode())
+
+        parts = request.split(" ")
+        ws = WebSocket(reader, writer, False, parts[1] if len(parts) > 1 else "/")
+        try:
+            await handler(ws)
+        except ConnectionClosed:
+            pass
+        finally:
+            ws.close()
+
+    return await asyncio.start_server(on_connection, host, port, ssl=ssl_context, backlog=backlog)
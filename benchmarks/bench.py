@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import protocol
+import swarm
+import territorialbot
+
+# benchmark suite, results go to a json file so runs on different commits can be compared.
+# fixtures are generated from a fixed seed, every number is the best of a few repeats.
+#
+#   python benchmarks/bench.py --out before.json
+#   python benchmarks/bench.py --out after.json
+#   python benchmarks/bench.py --compare before.json after.json
+
+SEED = 1234
+WIDTHS = (1, 4, 8, 10, 13, 16, 22, 32)
+
+def best(function, number, repeat=5):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+def nickname(rng):
+    return "".join(chr(rng.randint(32, 0x44F)) for _ in range(rng.randint(3, 31)))
+
+def lobby_fixture(rng):
+    return protocol.encode_lobby_update({
+        "online_bits": 14,
+        "online": [rng.randint(0, 16383) for _ in range(4)],
+        "battles": [{
+            "id": i,
+            "gamemode": rng.randint(0, 15),
+            "crown": rng.randint(0, 1),
+            "mapId": rng.randint(0, 63),
+            "seed": rng.randint(0, 16383),
+            "players": rng.randint(0, 512),
+            "maxPlayers": 512,
+            "time": rng.randint(0, 1023),
+            "clans": [{"online": rng.randint(1, 512), "clan": "".join(rng.choice("ABCXYZ") for _ in range(rng.randint(1, 7)))} for _ in range(rng.randint(0, 7))],
+        } for i in range(15)],
+    })
+
+def roster_fixture(rng, players=512):
+    return [{"flag": rng.randint(0, 1), "colors": [rng.randint(0, 63) for _ in range(3)], "nickname": nickname(rng)} for _ in range(players)]
+
+def scene_fixture(rng, players=512):
+    return protocol.encode_game_scene({
+        "index": rng.randint(0, 1023),
+        "challengeX": rng.randint(0, 1023),
+        "localPlayerId": rng.randint(0, players - 1),
+        "uY": rng.randint(0, 16383),
+        "ua": rng.randint(0, 15),
+        "a4V": True,
+        "a4W": rng.randint(0, 63),
+        "a4X": rng.randint(0, 16383),
+        "players": roster_fixture(rng, players),
+    })
+
+def game_frame_fixture(rng, events=64):
+    makers = [
+        lambda sender: protocol.PlaceBase(0, sender, rng.randint(0, (1 << 22) - 1)),
+        lambda sender: protocol.Attack(1, sender, rng.randint(0, 1023), rng.randint(0, 511)),
+        lambda sender: protocol.SendMoney(2, sender, rng.randint(0, 1023), rng.randint(0, 511)),
+        lambda sender: protocol.Emoji(6, sender, rng.randint(0, 1023)),
+        lambda sender: protocol.PlayerLeft(9, sender),
+    ]
+    return protocol.encode_game_frame([rng.choice(makers)(rng.randint(0, 511)) for _ in range(events)])
+
+def bench_codec(args, rng):
+    count = 4096 if not args.quick else 512
+    result = {}
+    for width in WIDTHS:
+        values = [rng.randint(0, (1 << width) - 1) for _ in range(count)]
+        buf = territorialbot.Buffer(territorialbot.Buffer.bits_to_bytes(width * count))
+
+        def write():
+            buf.write_offset = 0
+            buf.view[:] = bytes(len(buf.view))
+            for value in values:
+                buf.write_bits(width, value)
+
+        def read():
+            buf.read_offset = 0
+            for _ in range(count):
+                buf.decode_bits(width)
+
+        write()
+        result[f"write_bits_{width}"] = count / best(write, 3)
+        result[f"decode_bits_{width}"] = count / best(read, 3)
+    return {"unit": "fields/s", "fields": count, "results": result}
+
+def bench_read_str(args, rng):
+    names = [player["nickname"] for player in roster_fixture(rng)]
+    buf = territorialbot.Buffer(territorialbot.Buffer.bits_to_bytes(sum(5 + 16 * len(name) for name in names)))
+    for name in names:
+        buf.write_bits(5, len(name))
+        buf.write_str(name)
+
+    def read():
+        buf.read_offset = 0
+        for _ in names:
+            buf.read_str(buf.decode_bits(5))
+
+    seconds = best(read, 20 if not args.quick else 3)
+    return {"unit": "rosters/s", "players": len(names), "rosters_per_second": 1 / seconds, "strings_per_second": len(names) / seconds}
+
+def bench_challenge(args, rng):
+    pairs = [(rng.randint(16384, 65535), rng.randint(1 << 18, (1 << 20) - 1)) for _ in range(64)]
+    result = {}
+    for name, generator, reference_runs in (
+        ("challenge_generator", territorialbot.ChallengeGenerator, 3),
+        ("challenge_generator_old", territorialbot.ChallengeGeneratorOld, 1),
+    ):
+        fast = generator()
+        seconds = best(lambda: [fast.generate_challenge(*pair) for pair in pairs], 1) / len(pairs)
+        result[name] = {"fast_per_second": 1 / seconds}
+
+        # the step by step loops take seconds per challenge, measured on a few pairs only
+        if not args.quick:
+            slow = generator(fast=False)
+            seconds = best(lambda: [slow.generate_challenge(*pair) for pair in pairs[:reference_runs]], 1, repeat=1) / reference_runs
+            result[name]["reference_per_second"] = 1 / seconds
+    return {"unit": "challenges/s", "results": result}
+
+def bench_process_message(args, rng):
+    frames = {
+        "lobby_update": lobby_fixture(rng),
+        "game_scene_512": scene_fixture(rng),
+        "game_frame_64": game_frame_fixture(rng),
+    }
+    number = 200 if not args.quick else 20
+    result = {}
+
+    for name, frame in frames.items():
+        client = territorialbot.Client("bench")
+        client.switch_server = lambda url: None
+        client.connection_accepted = True
+        result[name] = {"bytes": len(frame), "frames_per_second": 1 / best(lambda: client.process_message(frame), number)}
+
+    # lobby frames that differ every time, so the lobby state decodes and diffs each of them
+    lobby_frames = [lobby_fixture(rng) for _ in range(8)]
+    client = territorialbot.Client("bench")
+    client.connection_accepted = True
+    cycle = iter(lobby_frames * (number * 5 // len(lobby_frames) + 1))
+    result["lobby_update_changed"] = {"bytes": len(lobby_frames[0]), "frames_per_second": 1 / best(lambda: client.process_message(next(cycle)), number // 5, repeat=5)}
+
+    # the same game frame with typed handlers on every id, so all events get decoded
+    client = territorialbot.Client("bench")
+    for id in protocol.GAME_EVENTS:
+        client.events.on(id, lambda client, event: None)
+    frame = frames["game_frame_64"]
+    result["game_frame_64_handlers"] = {"bytes": len(frame), "frames_per_second": 1 / best(lambda: client.process_message(frame), number)}
+    return {"unit": "frames/s", "results": result}
+
+def rss_bytes():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def bench_swarm(args, rng):
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "server.py"), "--port", "0", "--rooms", "8", "--room-size", "512", "--start-delay", "1"],
+        stdout=subprocess.PIPE, text=True
+    )
+    try:
+        port = int(server.stdout.readline())
+        return asyncio.run(swarm_bring_up(args, port))
+    finally:
+        server.kill()
+
+async def swarm_bring_up(args, port):
+    count = args.clients
+
+    def factory(index, proxy_options):
+        client = territorialbot.AsyncClient(
+            f"bench {index}",
+            lobby_address=f"ws://127.0.0.1:{port}/i31/",
+            game_address=f"ws://127.0.0.1:{port}/i3{{index}}/"
+        )
+
+        def on_lobby_update(client, rooms):
+            if client.join == False:
+                client.join = True
+                client.send_join_room(rooms[index % len(rooms)]["id"])
+
+        client.setup_callbacks(lobby_update_callback=on_lobby_update)
+        return client
+
+    baseline = rss_bytes()
+    clients = swarm.Swarm(factory, count, concurrency=200, connect_rate=0)
+    await clients.launch_async()
+    accepted = await clients.wait_for_async("accepted", 120)
+    lobby_rss = rss_bytes()
+    switched = await clients.wait_for_async("switched", 120)
+    game_rss = rss_bytes()
+
+    timings = clients.timings()
+    clients.disconnect()
+    return {
+        "clients": count,
+        "all_accepted": accepted,
+        "all_switched": switched,
+        "launch_seconds": timings["launch_time"],
+        "phases": timings["phases"],
+        "rss_per_client_lobby_bytes": (lobby_rss - baseline) / count,
+        "rss_per_client_game_bytes": (game_rss - baseline) / count,
+    }
+
+# import time, per client memory and per frame cost of both Buffer backends, each measured
+# in a fresh interpreter by footprint.py
+def bench_footprint(args, rng):
+    result = {}
+    for backend in ("numpy", "lean"):
+        output = subprocess.check_output(
+            [sys.executable, os.path.join(ROOT, "benchmarks", "footprint.py"), "--clients", str(args.clients * 4), "--frames", "2000" if args.quick else "20000"],
+            env=dict(os.environ, TERRITORIALBOT_BACKEND=backend), text=True
+        )
+        result[backend] = json.loads(output)
+    return result
+
+BENCHMARKS = {
+    "codec": bench_codec,
+    "read_str": bench_read_str,
+    "challenge": bench_challenge,
+    "process_message": bench_process_message,
+    "swarm": bench_swarm,
+    "footprint": bench_footprint,
+}
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+# prints every number present in both files as new / old, > 1 means the second run is higher
+def compare(old_path, new_path):
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+
+    def walk(old, new, path):
+        if isinstance(old, dict) and isinstance(new, dict):
+            for key in old:
+                if key in new:
+                    walk(old[key], new[key], path + [key])
+        elif isinstance(old, (int, float)) and isinstance(new, (int, float)) and not isinstance(old, bool) and old != 0:
+            print(f"{'.'.join(path):70} {old:14.6g} {new:14.6g} {new / old:8.3f}x")
+
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    walk(old["results"], new["results"], [])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default=None, help="json file for the results, stdout if not set")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="comma separated: " + ",".join(BENCHMARKS))
+    parser.add_argument("--clients", type=int, default=500, help="swarm size for the swarm benchmark")
+    parser.add_argument("--quick", action="store_true", help="fewer repeats, skips the reference challenge loops")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare != None:
+        compare(*args.compare)
+        return
+
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "quick": args.quick,
+        "results": {},
+    }
+
+    for name in args.only.split(","):
+        # each benchmark gets its own generator, so fixtures do not depend on which ones run
+        started = time.perf_counter()
+        report["results"][name] = BENCHMARKS[name](args, random.Random(f"{SEED}:{name}"))
+        print(f"{name}: {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.out != None:
+        with open(args.out, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
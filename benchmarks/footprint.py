@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# import time, per client memory and per frame cost of one Buffer backend. it has to run in
+# a fresh interpreter, so that nothing is imported before territorialbot. bench.py starts it
+# once per backend, or by hand:
+#
+#   TERRITORIALBOT_BACKEND=lean python benchmarks/footprint.py --clients 2000
+
+def rss_bytes():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def per_frame(client, frame, number):
+    # warm up, then the cost of one call and the memory it allocates on the way
+    client.process_message(frame)
+    started = time.perf_counter()
+    for _ in range(number):
+        client.process_message(frame)
+    seconds = (time.perf_counter() - started) / number
+
+    tracemalloc.start()
+    client.process_message(frame)
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    client.process_message(frame)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return {"bytes": len(frame), "frames_per_second": 1 / seconds, "peak_allocated_bytes": peak}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--frames", type=int, default=20000)
+    args = parser.parse_args()
+
+    rss_start = rss_bytes()
+    started = time.perf_counter()
+    import territorialbot
+    import protocol
+    import_seconds = time.perf_counter() - started
+    rss_imported = rss_bytes()
+    numpy_imported = "numpy" in sys.modules
+
+    tracemalloc.start()
+    clients = [territorialbot.Client(f"bot {i}") for i in range(args.clients)]
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss_clients = rss_bytes()
+
+    client = clients[0]
+    frames = {
+        "private_emoji": protocol.encode_private_event(protocol.PrivateEmoji(12, 3, 1022)),
+        "game_frame_1": protocol.encode_game_frame([protocol.Attack(1, 3, 512, 7)]),
+        "game_frame_8": protocol.encode_game_frame([protocol.SendMoney(2, i, 100, 7) for i in range(8)]),
+    }
+
+    buffers_started = time.perf_counter()
+    for _ in range(args.frames):
+        buf = territorialbot.Buffer(data=frames["private_emoji"])
+        buf.decode_bits(13)
+    buffer_seconds = (time.perf_counter() - buffers_started) / args.frames
+
+    print(json.dumps({
+        "backend": territorialbot.BACKEND,
+        "import_seconds": import_seconds,
+        "numpy_imported": numpy_imported,
+        "rss_import_bytes": rss_imported - rss_start,
+        "client_bytes_traced": traced / args.clients,
+        "client_bytes_rss": (rss_clients - rss_imported) / args.clients,
+        "buffer_per_second": 1 / buffer_seconds,
+        "frames": {name: per_frame(client, frame, args.frames) for name, frame in frames.items()},
+    }))
+
+if __name__ == "__main__":
+    main()
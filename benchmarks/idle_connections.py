@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import territorialbot
+
+# memory and cpu cost of idle connections that finished the lobby handshake.
+# the stand-in server (server.py) runs in a child process, nobody joins a room
+# so after the first lobby update the connections stay silent.
+#
+#   python benchmarks/idle_connections.py --clients 1000 --engine async
+#   python benchmarks/idle_connections.py --clients 1000 --engine threads
+
+def rss_bytes():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+async def connect_async(url, count, concurrency):
+    clients = [territorialbot.AsyncClient(f"bot {i}", lobby_address=url) for i in range(count)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def open_one(client):
+        async with semaphore:
+            await client.connect()
+        await client.listen()
+
+    tasks = [asyncio.ensure_future(open_one(client)) for client in clients]
+    while sum(client.connection_accepted for client in clients) < count:
+        await asyncio.sleep(0.05)
+    return clients, tasks
+
+def connect_threads(url, count):
+    clients = []
+    for i in range(count):
+        client = territorialbot.Client(f"bot {i}", lobby_address=url)
+        client.start()
+        clients.append(client)
+    while sum(client.connection_accepted for client in clients) < count:
+        time.sleep(0.05)
+    return clients
+
+def measure(args, url):
+    baseline_rss = rss_bytes()
+    baseline_threads = threading.active_count()
+    started = time.perf_counter()
+
+    if args.engine == "async":
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        clients, tasks = loop.run_until_complete(connect_async(url, args.clients, args.concurrency))
+    else:
+        clients = connect_threads(url, args.clients)
+
+    bring_up = time.perf_counter() - started
+    connected_rss = rss_bytes()
+    threads = threading.active_count() - baseline_threads
+
+    cpu_before = time.process_time()
+    if args.engine == "async":
+        loop.run_until_complete(asyncio.sleep(args.idle))
+    else:
+        time.sleep(args.idle)
+    idle_cpu = time.process_time() - cpu_before
+
+    for client in clients:
+        client.disconnect()
+
+    return {
+        "engine": args.engine,
+        "clients": args.clients,
+        "bring_up_seconds": bring_up,
+        "rss_per_connection_bytes": (connected_rss - baseline_rss) / args.clients,
+        "threads_per_connection": threads / args.clients,
+        "idle_seconds": args.idle,
+        "idle_cpu_per_connection_seconds": idle_cpu / args.clients,
+        "idle_cpu_percent": 100 * idle_cpu / args.idle,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--engine", choices=["async", "threads"], default="async")
+    parser.add_argument("--idle", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), "--port", "0"], stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline())
+        result = measure(args, f"ws://127.0.0.1:{port}/i31/")
+    finally:
+        server.kill()
+
+    print(json.dumps(result, indent=2))
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
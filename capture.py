@@ -0,0 +1,206 @@
+import argparse
+import mmap
+import struct
+import time
+from threading import Lock
+
+import territorialbot
+
+# binary capture of client traffic and offline replay through Client.process_message.
+# record with
+#   recorder = capture.Recorder("match.cap")
+#   client = territorialbot.Client(nick, recorder=recorder)
+# and replay with
+#   python capture.py replay match.cap [--speed 1]
+#
+# file layout: MAGIC, then records of
+#   u32 payload length, u64 time.monotonic_ns(), u8 direction, u16 client id, payload
+# a CLIENT record carries the nickname of a new client id, TEXT is or-ed into the direction of text frames
+
+MAGIC = b"TBCAP\x00\x01\x00"
+RECORD = struct.Struct("<IQBH")
+
+INBOUND = 0
+OUTBOUND = 1
+CLIENT = 2
+TEXT = 0x80
+
+class Recorder:
+    def __init__(self, path, buffering=1 << 16):
+        self.path = path
+        self.lock = Lock()
+        self.file = open(path, "wb", buffering=buffering)
+        self.file.write(MAGIC)
+        self.clients = 0
+        self.records = 0
+
+    def register(self, nickname):
+        with self.lock:
+            id = self.clients
+            self.clients += 1
+        self.record(id, CLIENT, nickname.encode("utf-8"))
+        return id
+
+    def record(self, id, direction, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+            direction |= TEXT
+        header = RECORD.pack(len(data), time.monotonic_ns(), direction, id)
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(header)
+            self.file.write(data)
+            self.records += 1
+
+    def inbound(self, id, data):
+        self.record(id, INBOUND, data)
+
+    def outbound(self, id, data):
+        self.record(id, OUTBOUND, data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# memory maps a capture, records are read as (timestamp_ns, direction, client id, payload)
+# with the payload a memoryview into the map, nothing is copied
+class Capture:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        if self.view[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a capture file")
+        self.nicknames = {}
+
+    def __iter__(self):
+        view = self.view
+        end = len(view)
+        offset = len(MAGIC)
+        size = RECORD.size
+        unpack = RECORD.unpack_from
+
+        while offset + size <= end:
+            length, timestamp, direction, id = unpack(view, offset)
+            offset += size
+            if offset + length > end:
+                # truncated last record, the recorder was not closed
+                return
+            payload = view[offset:offset + length]
+            offset += length
+
+            if direction == CLIENT:
+                self.nicknames[id] = bytes(payload).decode("utf-8", "replace")
+            yield timestamp, direction, id, payload
+
+    def summary(self):
+        clients = {}
+        first = last = None
+        for timestamp, direction, id, payload in self:
+            first = timestamp if first == None else first
+            last = timestamp
+            if direction == CLIENT:
+                continue
+            stats = clients.setdefault(id, {"in_frames": 0, "in_bytes": 0, "out_frames": 0, "out_bytes": 0})
+            kind = "in" if direction & ~TEXT == INBOUND else "out"
+            stats[kind + "_frames"] += 1
+            stats[kind + "_bytes"] += len(payload)
+
+        return {
+            "duration": (last - first) / 1e9 if first != None else 0,
+            "clients": {self.nicknames.get(id, str(id)): stats for id, stats in clients.items()},
+        }
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # a payload view is still referenced somewhere, the map goes away with it
+            pass
+        self.file.close()
+
+def offline_client(nickname, logging=False):
+    client = territorialbot.Client(nickname, logging=logging)
+    # redirects are part of the capture already, nothing to connect to
+    client.switch_server = lambda url: None
+    return client
+
+# feeds the inbound frames of a capture to one client per recorded client id.
+# speed=None replays as fast as possible, speed=1 at the recorded pace, 2 twice as fast.
+# factory(nickname) builds the clients, set up callbacks there to replay through them
+def replay(path, factory=offline_client, speed=None, clients=None):
+    capture = Capture(path)
+    clients = {} if clients == None else clients
+    frames = 0
+    size = 0
+    start_recorded = None
+    started = time.perf_counter()
+
+    try:
+        for timestamp, direction, id, payload in capture:
+            if direction == CLIENT:
+                if id not in clients:
+                    clients[id] = factory(capture.nicknames[id])
+                continue
+            if direction & ~TEXT != INBOUND:
+                continue
+
+            if speed != None:
+                if start_recorded == None:
+                    start_recorded = timestamp
+                delay = (timestamp - start_recorded) / 1e9 / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            message = bytes(payload).decode("utf-8", "replace") if direction & TEXT else payload
+            client = clients.get(id)
+            if client == None:
+                client = clients[id] = factory(str(id))
+            client.process_message(message)
+            frames += 1
+            size += len(payload)
+    finally:
+        capture.close()
+
+    seconds = time.perf_counter() - started
+    return {
+        "clients": len(clients),
+        "frames": frames,
+        "bytes": size,
+        "seconds": seconds,
+        "frames_per_second": frames / seconds if seconds > 0 else 0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["info", "replay"])
+    parser.add_argument("path")
+    parser.add_argument("--speed", type=float, default=None, help="1 for the recorded pace, as fast as possible if not set")
+    parser.add_argument("--logging", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        capture = Capture(args.path)
+        summary = capture.summary()
+        capture.close()
+        print(f"duration: {summary['duration']:.3f}s")
+        for nickname, stats in summary["clients"].items():
+            print(f"{nickname}: in {stats['in_frames']} frames / {stats['in_bytes']} bytes, out {stats['out_frames']} frames / {stats['out_bytes']} bytes")
+        return
+
+    def factory(nickname):
+        return offline_client(nickname, args.logging)
+
+    stats = replay(args.path, factory, args.speed)
+    print(f"{stats['frames']} frames ({stats['bytes']} bytes) for {stats['clients']} clients in {stats['seconds']:.3f}s, {stats['frames_per_second']:.0f} frames/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+from array import array
+import atexit
+import itertools
+import json
+import struct
+import sys
+import time
+from threading import Event, Lock, Thread
+
+# structured log of client traffic. the client side only packs a fixed size record into its
+# own preallocated ring, a background thread moves the rings to a sink every interval as
+# json lines or as binary records, so logging swarms keep their timing.
+#
+#   log = eventlog.EventLog("swarm.jsonl", sample={(eventlog.GAME_IN, 1): 0.01})
+#   client = territorialbot.Client(nick, logging=log)
+#
+# Client(logging=True) writes json lines to stdout through default_log().
+# record: u64 time.time_ns(), u32 client id, u8 kind, u8 event id, u32 length
+# binary files are MAGIC and then records, a NAME record (length = name size, followed by
+# the utf-8 nickname) comes before the first record of a client id, see read()
+
+RECORD = struct.Struct("<QIBBxxI")
+MAGIC = b"TBLOG\x00\x01\x00"
+
+LOBBY_IN = 0
+GAME_IN = 1
+PRIVATE_IN = 2
+LOBBY_OUT = 3
+ACTION_OUT = 4
+SEND_ERROR = 5
+CONNECTED = 6
+NAME = 255
+
+# sampling table size, kinds above times 64 event ids
+SLOTS = 8 * 64
+
+KINDS = {
+    LOBBY_IN: ("in", "lobby"),
+    GAME_IN: ("in", "game"),
+    PRIVATE_IN: ("in", "private"),
+    LOBBY_OUT: ("out", "lobby"),
+    ACTION_OUT: ("out", "action"),
+    SEND_ERROR: ("out", "error"),
+    CONNECTED: ("in", "connected"),
+}
+
+# ring of one client. records are claimed with a counter, so writers on other threads
+# (outbound writers, timers) do not need a lock. every slot carries the sequence of the
+# record in it, -1 while it is being written, the flusher only takes records whose
+# sequence it expects and stops at the first one not written yet
+class ClientLog:
+    __slots__ = ("log", "id", "nickname", "buffer", "stamps", "capacity", "counter", "written", "read")
+
+    def __init__(self, log, id, nickname, capacity):
+        self.log = log
+        self.id = id
+        self.nickname = nickname
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.stamps = array("q", [-1]) * capacity
+        self.capacity = capacity
+        self.counter = itertools.count()
+        self.written = 0
+        self.read = 0
+
+    def record(self, kind, event, length):
+        slot = kind * 64 + (event & 63)
+        every = self.log.every[slot]
+        if every != 1:
+            if every == 0 or next(self.log.counters[slot]) % every:
+                return
+        i = next(self.counter)
+        slot = i % self.capacity
+        self.stamps[slot] = -1
+        RECORD.pack_into(self.buffer, slot * RECORD.size, time.time_ns(), self.id, kind, event, length)
+        self.stamps[slot] = i
+        # only a hint where the ring ends, writers may set it out of order
+        if i >= self.written:
+            self.written = i + 1
+
+    # outgoing frame, lobby message or game action told apart by the first bit
+    def outbound(self, data):
+        first = data[0]
+        if first < 128:
+            self.record(LOBBY_OUT, (first >> 1) & 63, len(data))
+        else:
+            self.record(ACTION_OUT, (first >> 3) & 15, len(data))
+
+class EventLog:
+    # sink is a path or a file object, stdout when None. format is "jsonl" or "binary".
+    # capacity records per client are kept between flushes, older ones are dropped and counted.
+    # sample maps (kind, event id) or (kind, None) to the part of those records that is kept
+    def __init__(self, sink=None, format="jsonl", capacity=256, interval=0.1, sample=None):
+        if format not in ("jsonl", "binary"):
+            raise ValueError(f"unknown format {format}")
+        self.format = format
+        self.capacity = capacity
+        self.interval = interval
+        if sink == None:
+            sink = sys.stdout.buffer if format == "binary" else sys.stdout
+        self.file = open(sink, "wb" if format == "binary" else "w") if isinstance(sink, str) else sink
+        self.owns_file = isinstance(sink, str)
+        if format == "binary":
+            self.file.write(MAGIC)
+
+        self.lock = Lock()
+        self.clients = []
+        self.named = set()
+        # keep one in every[slot] records, counted over all clients
+        self.every = [1] * SLOTS
+        self.counters = {}
+        for (kind, event), rate in (sample or {}).items():
+            self.sample(kind, rate, event)
+
+        self.records = 0
+        self.dropped = 0
+        self.stopped = Event()
+        self.thread = None
+
+    # keeps about rate of the records of kind (and event id), 1 keeps all, 0 none
+    def sample(self, kind, rate, event=None):
+        every = 0 if rate <= 0 else max(1, round(1 / rate))
+        for id in (range(64) if event == None else (event,)):
+            self.every[kind * 64 + id] = every
+            self.counters.setdefault(kind * 64 + id, itertools.count())
+
+    def client(self, nickname):
+        with self.lock:
+            log = ClientLog(self, len(self.clients), nickname, self.capacity)
+            self.clients.append(log)
+            if self.thread == None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return log
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    # records of one ring since the last flush, as bytes
+    def take(self, log):
+        capacity = log.capacity
+        stamps = log.stamps
+        buffer = log.buffer
+        size = RECORD.size
+        i = max(log.read, log.written - capacity)
+        dropped = i - log.read
+
+        records = []
+        # at most one lap per flush, the rest is left for the next one
+        for i in range(i, i + capacity):
+            slot = i % capacity
+            stamp = stamps[slot]
+            if stamp == -1 or stamp < i:
+                # claimed but not written yet
+                break
+            if stamp == i:
+                record = bytes(buffer[slot * size:(slot + 1) * size])
+                # checked again after the copy, a writer may have come around meanwhile
+                if stamps[slot] == i:
+                    records.append(record)
+                    continue
+            # overwritten by a later lap
+            dropped += 1
+        else:
+            i += 1
+        log.read = i
+        return b"".join(records), dropped
+
+    def flush(self):
+        with self.lock:
+            clients = list(self.clients)
+            for log in clients:
+                data, dropped = self.take(log)
+                self.dropped += dropped
+                if len(data) > 0:
+                    self.write(log, data)
+            self.file.flush()
+
+    def write(self, log, data):
+        count = len(data) // RECORD.size
+        self.records += count
+        if self.format == "binary":
+            if log.id not in self.named:
+                self.named.add(log.id)
+                name = log.nickname.encode("utf-8")
+                self.file.write(RECORD.pack(time.time_ns(), log.id, NAME, 0, len(name)) + name)
+            self.file.write(data)
+            return
+
+        lines = []
+        for timestamp, id, kind, event, length in RECORD.iter_unpack(data):
+            direction, kind_name = KINDS.get(kind, ("", str(kind)))
+            lines.append(json.dumps({"time": timestamp / 1e9, "client": log.nickname, "client_id": id, "direction": direction, "kind": kind_name, "event": event, "length": length}))
+        self.file.write("\n".join(lines) + "\n")
+
+    def stats(self):
+        return {"clients": len(self.clients), "records": self.records, "dropped": self.dropped}
+
+    def close(self):
+        self.stopped.set()
+        if self.thread != None:
+            self.thread.join()
+        self.flush()
+        if self.owns_file:
+            self.file.close()
+
+# records of a binary log as dicts, like the json lines
+def read(path):
+    names = {}
+    with open(path, "rb") as file:
+        data = file.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not an event log")
+
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        timestamp, id, kind, event, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if kind == NAME:
+            names[id] = data[offset:offset + length].decode("utf-8", "replace")
+            offset += length
+            continue
+        direction, kind_name = KINDS.get(kind, ("", str(kind)))
+        yield {"time": timestamp / 1e9, "client": names.get(id), "client_id": id, "direction": direction, "kind": kind_name, "event": event, "length": length}
+
+default = None
+default_lock = Lock()
+
+# json lines on stdout, shared by every Client(logging=True)
+def default_log():
+    global default
+    with default_lock:
+        if default == None:
+            default = EventLog()
+            # the flusher is a daemon thread, whatever is left goes out at exit
+            atexit.register(default.flush)
+        return default
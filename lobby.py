@@ -0,0 +1,179 @@
+from collections import namedtuple
+from threading import Lock
+
+import protocol
+
+# lobby state (event 2) kept across updates. battles are dicts keyed by id, updated in place,
+# with indexes by gamemode, map and fill level. every update is turned into a LobbyDelta:
+#   added    battle dicts that appeared
+#   removed  battle dicts that are gone
+#   changed  {id: {field: (old, new)}} for battles that are still there
+#   online   the new online counters, None when they did not change
+# a frame equal to the last applied one is skipped before decoding, so one LobbyState can
+# be shared by many clients watching the same lobby and only the first copy of a frame
+# counts. update() with a source (the client) also skips copies that source delivers late:
+# frames applied after the last one it delivered. a lobby going back to an earlier state
+# is still applied, the source saw the newer frame already
+
+FIELDS = ("gamemode", "crown", "mapId", "seed", "players", "maxPlayers", "time", "clans")
+FILL_LEVELS = 8
+
+LobbyDelta = namedtuple("LobbyDelta", "added removed changed online")
+
+class LobbyState:
+    def __init__(self, history=4):
+        self.lock = Lock()
+        self.history = history
+        self.last = None
+        self.version = 0
+        # frame -> version it was last applied as, the history most recent ones
+        self.versions = {}
+        # source -> version of the last frame it delivered
+        self.positions = {}
+        self.battles = {}
+        self.rooms = []
+        self.online = []
+        self.updates = 0
+        self.skipped = 0
+
+        self.by_gamemode = {}
+        self.by_map = {}
+        # (gamemode, level) -> ids, gamemode None holds every battle
+        self.by_fill = {}
+        self.levels = {}
+
+    @staticmethod
+    def fill_level(battle):
+        return min(FILL_LEVELS - 1, battle["players"] * FILL_LEVELS // battle["maxPlayers"])
+
+    # buf is positioned after the event id, returns None when nothing changed
+    def update(self, buf, source=None):
+        frame = bytes(buf.view)
+        with self.lock:
+            if frame == self.last:
+                if source != None:
+                    self.positions[source] = self.version
+                self.skipped += 1
+                return None
+            if source != None:
+                version = self.versions.get(frame)
+                if version != None and version > self.positions.get(source, 0):
+                    # a copy of a frame applied already, this source lags behind
+                    self.positions[source] = version
+                    self.skipped += 1
+                    return None
+
+            self.version += 1
+            self.last = frame
+            self.versions.pop(frame, None)
+            self.versions[frame] = self.version
+            if len(self.versions) > self.history:
+                del self.versions[next(iter(self.versions))]
+            if source != None:
+                self.positions[source] = self.version
+            self.updates += 1
+            delta = self.apply(protocol.decode_lobby_update(buf))
+
+        if not (delta.added or delta.removed or delta.changed) and delta.online == None:
+            return None
+        return delta
+
+    # source went away, a new one with the same key starts from the beginning
+    def forget(self, source):
+        with self.lock:
+            self.positions.pop(source, None)
+
+    def apply(self, update):
+        online = None
+        if update["online"] != self.online:
+            online = self.online = update["online"]
+
+        added = []
+        changed = {}
+        order = []
+        for battle in update["battles"]:
+            id = battle["id"]
+            order.append(id)
+            current = self.battles.get(id)
+            if current == None:
+                self.battles[id] = battle
+                self.index(battle)
+                added.append(battle)
+                continue
+
+            fields = {field: (current[field], battle[field]) for field in FIELDS if current[field] != battle[field]}
+            if fields:
+                reindex = "gamemode" in fields or "mapId" in fields or self.fill_level(battle) != self.levels[id]
+                if reindex:
+                    self.unindex(current)
+                for field, (old, new) in fields.items():
+                    current[field] = new
+                if reindex:
+                    self.index(current)
+                changed[id] = fields
+
+        removed = []
+        if len(self.battles) > len(order):
+            ids = set(order)
+            for id in [id for id in self.battles if id not in ids]:
+                battle = self.battles.pop(id)
+                self.unindex(battle)
+                removed.append(battle)
+
+        # the list handed to lobby_update_callback, only rebuilt when the battles move
+        if added or removed or len(order) != len(self.rooms) or any(room["id"] != id for room, id in zip(self.rooms, order)):
+            self.rooms = [self.battles[id] for id in order]
+
+        return LobbyDelta(added, removed, changed, online)
+
+    def index(self, battle):
+        id = battle["id"]
+        level = self.fill_level(battle)
+        self.levels[id] = level
+        self.by_gamemode.setdefault(battle["gamemode"], set()).add(id)
+        self.by_map.setdefault(battle["mapId"], set()).add(id)
+        self.by_fill.setdefault((battle["gamemode"], level), set()).add(id)
+        self.by_fill.setdefault((None, level), set()).add(id)
+
+    def unindex(self, battle):
+        id = battle["id"]
+        level = self.levels.pop(id)
+        for table, key in (
+            (self.by_gamemode, battle["gamemode"]),
+            (self.by_map, battle["mapId"]),
+            (self.by_fill, (battle["gamemode"], level)),
+            (self.by_fill, (None, level)),
+        ):
+            ids = table[key]
+            ids.discard(id)
+            if len(ids) == 0:
+                del table[key]
+
+    def get(self, id):
+        return self.battles.get(id)
+
+    def with_gamemode(self, gamemode):
+        with self.lock:
+            return [self.battles[id] for id in self.by_gamemode.get(gamemode, ())]
+
+    def with_map(self, map_id):
+        with self.lock:
+            return [self.battles[id] for id in self.by_map.get(map_id, ())]
+
+    # looks at the FILL_LEVELS buckets only, a lobby has at most 15 battles to pick from
+    def least_full(self, gamemode=None):
+        return self.by_fill_level(gamemode, range(FILL_LEVELS), min)
+
+    def most_full(self, gamemode=None):
+        return self.by_fill_level(gamemode, range(FILL_LEVELS - 1, -1, -1), max)
+
+    def by_fill_level(self, gamemode, levels, pick):
+        with self.lock:
+            for level in levels:
+                ids = self.by_fill.get((gamemode, level))
+                if ids:
+                    return pick((self.battles[id] for id in ids), key=lambda battle: battle["players"] / battle["maxPlayers"])
+        return None
+
+    def stats(self):
+        return {"battles": len(self.battles), "updates": self.updates, "skipped": self.skipped}
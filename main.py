@@ -1,7 +1,11 @@
+from functools import partial
+
 import territorialbot
+import shard
+import swarm
 
 class HelperBot:
-    def __init__(self, nickname, friend_name, bot_index):
+    def __init__(self, nickname, friend_name, bot_index, proxy_options=None, connection_pool=None):
         self.bot_index = bot_index
         self.bases_count = 0
         self.target = None
@@ -10,17 +14,20 @@ class HelperBot:
         self.friend_id = None
         self.has_joined_room = False
         self.have_base = False
+        self.swarm = None
 
-        self.bot = territorialbot.Client(nickname, logging=False)
+        self.bot = territorialbot.Client(nickname, logging=False, proxy_options=proxy_options, connection_pool=connection_pool, track_match=True)
         self.bot.setup_callbacks(
             lobby_update_callback=self.on_lobby_update,
-            game_event_callback=self.game_event_callback,
             game_scene_callback=self.game_scene_callback,
-            private_event_callback=self.private_event_callback,
             disconnect_callback=self.on_disconnect
         )
-        
-        self.bot.start()
+        self.bot.events.on(0, self.on_place_base)
+        self.bot.events.on(1, self.on_attack)
+        self.bot.events.on(6, self.on_emoji)
+        self.bot.events.on_private(12, self.on_private_emoji)
+        self.bot.events.on_private(13, self.on_clan_request)
+        self.bot.events.on_private(14, self.on_private_target)
 
     def on_disconnect(self, bot, outdated):
         print(f"{self.nickname} disconnected by server")
@@ -33,69 +40,106 @@ class HelperBot:
             print(f"{self.nickname} joined {room_id}")
 
     def game_scene_callback(self, bot, players, url):
-        for player in players:
-            nickname = player["nickname"]
-            if nickname == self.friend_name:
-                self.friend_id = player["id"]
-                print(f"Friend {nickname} found with id {self.friend_id}")
-
-    def game_event_callback(self, bot, buf:territorialbot.Buffer, id, sender):
-        if sender == self.friend_id:
-            print("Friend event", id)
-            if id == 0:
-                if self.have_base == False:
-                    if self.bot_index == self.bases_count:
-                        self.have_base = True
-                        pos = buf.decode_bits(22)
-                        self.bot.send_set_base(pos)
-
-                        print(f"Set base for {self.nickname}")
-
-                        buf.read_offset -= 22
-                self.bases_count += 1
-            elif id == 1:
-                percentage = buf.decode_bits(10)
-                target = buf.decode_bits(10)
-
-                print("Copy friend attack", target, percentage)
-
-                self.attack(target, percentage)
-
-                buf.read_offset -= 20
-            elif id == 6:
-                emoji = buf.decode_bits(10)
-
-                buf.read_offset -= 10
-                print("Friend set emoji", emoji)
-
-    def private_event_callback(self, bot, buf:territorialbot.Buffer, id, sender):
-        if sender != self.friend_id:
+        friend_id = players.find(self.friend_name)
+        if friend_id != None:
+            self.friend_id = friend_id
+            print(f"Friend {self.friend_name} found with id {self.friend_id}")
+
+    def on_place_base(self, bot, event:territorialbot.protocol.PlaceBase):
+        if event.sender != self.friend_id:
+            return
+
+        print("Friend event", event.id)
+        if self.have_base == False:
+            if self.bot_index == self.bases_count:
+                self.have_base = True
+                self.bot.send_set_base(event.pos)
+
+                print(f"Set base for {self.nickname}")
+        self.bases_count += 1
+
+    def on_attack(self, bot, event:territorialbot.protocol.Attack):
+        if event.sender != self.friend_id:
+            return
+
+        if self.swarm == None:
+            self.attack(event.target, event.percentage)
+            return
+
+        # every helper sees the attack, only one of them sends it for the whole swarm
+        if self.swarm.is_leader(bot):
+            print("Copy friend attack", event.target, event.percentage)
+            self.swarm.broadcast(swarm.attack_action(event.percentage, event.target))
+
+    def on_emoji(self, bot, event:territorialbot.protocol.Emoji):
+        if event.sender == self.friend_id:
+            print("Friend set emoji", event.emoji)
+
+    def on_private_emoji(self, bot, event:territorialbot.protocol.PrivateEmoji):
+        if event.sender != self.friend_id:
             return
 
-        if id == 12:
-            emoji = buf.decode_bits(10)
-            print(f"Private emoji for {self.nickname}: {emoji}")
-            if emoji == 1022: # help
-                self.bot.send_money(self.friend_id, 400)
-            elif emoji == 697: # copy attack
-                if self.target != None:
-                    self.attack(self.target, 200)
-        elif id == 13:
-            self.bot.send_clan_request(sender)
-        elif id == 14:
-            self.target = buf.decode_bits(9)
-            self.attack(self.target, 100)
+        print(f"Private emoji for {self.nickname}: {event.emoji}")
+        if event.emoji == 1022: # help
+            self.bot.send_money(self.friend_id, 400)
+            if bot.match != None:
+                print(f"{self.friend_name} is attacked by {bot.match.attackers(self.friend_id)}")
+        elif event.emoji == 697: # copy attack
+            if self.target != None:
+                self.attack(self.target, 200)
+
+    def on_clan_request(self, bot, event:territorialbot.protocol.ClanRequest):
+        if event.sender != self.friend_id:
+            return
+
+        self.bot.send_clan_request(event.sender)
+
+    def on_private_target(self, bot, event:territorialbot.protocol.PrivateTarget):
+        if event.sender != self.friend_id:
+            return
 
-            print("Apply friend attack", self.target)
+        self.target = event.target
+        self.attack(self.target, 100)
 
-        print("Private event", id)
+        print("Apply friend attack", self.target)
 
     def attack(self, target, percentage):
         self.bot.send_attack(percentage, target)
 
     @staticmethod
-    def create_bots(amount, nick, friend_name):
-        for i in range(amount):
-            bot = HelperBot(f"{nick} ({i})", friend_name, i)
+    def create_bots(amount, nick, friend_name, proxies=None):
+        helpers = [None] * amount
+        # keeps a warm socket per bot, so the whole swarm moves to the game server at once
+        pool = territorialbot.ConnectionPool()
+
+        def factory(i, proxy_options):
+            helpers[i] = HelperBot(f"{nick} ({i})", friend_name, i, proxy_options, pool)
+            helpers[i].swarm = bots
+            return helpers[i].bot
+
+        bots = swarm.Swarm(factory, amount, proxy_options=proxies, shared_decoding=True)
+        bots.launch()
+        return helpers, bots
+
+    # the same swarm spread over worker processes, one Swarm per shard. the helpers live in
+    # the shards, the returned ShardedSwarm sends commands to all of them
+    @staticmethod
+    def create_sharded_bots(amount, nick, friend_name, shards=None, proxies=None):
+        bots = shard.ShardedSwarm(partial(make_helper, nick, friend_name), amount, shards=shards, proxy_options=proxies, shared_decoding=True)
+        bots.start()
+        return bots
+
+# runs inside a shard process, one pool per shard
+shard_pool = None
+
+def make_helper(nick, friend_name, index, proxy_options):
+    global shard_pool
+    if shard_pool == None:
+        shard_pool = territorialbot.ConnectionPool()
+
+    helper = HelperBot(f"{nick} ({index})", friend_name, index, proxy_options, shard_pool)
+    helper.swarm = shard.current.swarm
+    return helper.bot
 
-HelperBot.create_bots(3, "kuzheren's b0t", "kuzheren")
+if __name__ == "__main__":
+    HelperBot.create_bots(3, "kuzheren's b0t", "kuzheren")
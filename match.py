@@ -0,0 +1,102 @@
+import time
+
+import numpy as np
+
+# state of the running game built from the broadcast events, one row or column per 9 bit
+# player id. every event is an O(1) update of a few cells, snapshot() hands out read only
+# views of the arrays without copying.
+#
+#   client = territorialbot.Client(nick, track_match=True)
+#   ...
+#   client.match.attackers(friend_id)
+#
+# attacks on targets outside the roster (unclaimed land) only count in neutral_attacks
+
+EMOJI_DTYPE = np.dtype([("time", np.float64), ("sender", np.uint16), ("emoji", np.uint16)])
+
+class MatchState:
+    # event ids that change the state, the client decodes only these for it
+    EVENTS = (0, 1, 2, 5, 6, 9)
+
+    # window is how long an attack counts as going on in attackers()
+    def __init__(self, players=512, window=3.0, emoji_history=256):
+        self.players = players
+        self.window = window
+        self.events = 0
+
+        self.alive = np.ones(players, dtype=bool)
+        self.left = np.zeros(players, dtype=bool)
+        self.base = np.full(players, -1, dtype=np.int32)
+        self.attack_count = np.zeros((players, players), dtype=np.uint32)
+        self.attack_percentage = np.zeros((players, players), dtype=np.uint16)
+        self.neutral_attacks = np.zeros(players, dtype=np.uint32)
+        self.money = np.zeros((players, players), dtype=np.int32)
+        self.last_emoji = np.full(players, -1, dtype=np.int16)
+        self.emojis = np.zeros(emoji_history, dtype=EMOJI_DTYPE)
+        self.emoji_count = 0
+
+        # target -> {sender: time of the last attack}, what attackers() answers from
+        self.recent = {}
+
+    def feed(self, event, now=None):
+        id = event[0]
+        sender = event[1]
+        if sender >= self.players:
+            return
+        self.events += 1
+
+        if id == 1:
+            target = event.target
+            if target < self.players:
+                self.attack_count[sender, target] += 1
+                self.attack_percentage[sender, target] = event.percentage
+                attackers = self.recent.get(target)
+                if attackers == None:
+                    attackers = self.recent[target] = {}
+                attackers[sender] = time.monotonic() if now == None else now
+            else:
+                self.neutral_attacks[sender] += 1
+        elif id == 0:
+            self.base[sender] = event.pos
+        elif id == 2:
+            if event.target < self.players:
+                self.money[sender, event.target] += event.value
+        elif id == 5 or id == 6:
+            self.last_emoji[sender] = event.emoji
+            self.emojis[self.emoji_count % len(self.emojis)] = (time.monotonic() if now == None else now, sender, event.emoji)
+            self.emoji_count += 1
+        elif id == 9:
+            self.alive[sender] = False
+            self.left[sender] = True
+            self.recent.pop(sender, None)
+
+    # players still in the game that attacked target within the window
+    def attackers(self, target, window=None, now=None):
+        attackers = self.recent.get(target)
+        if not attackers:
+            return []
+        since = (time.monotonic() if now == None else now) - (self.window if window == None else window)
+        alive = self.alive
+        return [sender for sender, last in attackers.items() if last >= since and alive[sender]]
+
+    def is_attacking(self, sender, target, window=None, now=None):
+        last = self.recent.get(target, {}).get(sender)
+        return last != None and last >= (time.monotonic() if now == None else now) - (self.window if window == None else window) and bool(self.alive[sender])
+
+    # the last emojis, oldest first
+    def emoji_history(self):
+        size = len(self.emojis)
+        if self.emoji_count <= size:
+            return self.emojis[:self.emoji_count]
+        start = self.emoji_count % size
+        return np.concatenate((self.emojis[start:], self.emojis[:start]))
+
+    # read only views of the arrays, they keep following the state
+    def snapshot(self):
+        views = {}
+        for name in ("alive", "left", "base", "attack_count", "attack_percentage", "neutral_attacks", "money", "last_emoji"):
+            view = getattr(self, name).view()
+            view.flags.writeable = False
+            views[name] = view
+        views["events"] = self.events
+        return views
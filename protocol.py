@@ -0,0 +1,560 @@
+import hashlib
+import marshal
+import os
+import sys
+from collections import namedtuple
+
+# message layouts of the game protocol, declared as data.
+# at import time every message is compiled into straight-line python:
+#   decode_<name>(buf)  reads the fields from a territorialbot.Buffer positioned after the header,
+#                       game events take (buf, sender) and return their event tuple
+#   pack_<name>(msg)    returns (bits_count, value) with the fields packed msb-first
+#   encode_<name>(msg)  returns the whole frame (header + fields) as bytes, for messages with a header
+# consecutive fixed width fields are read with a single decode_bits call and split with shifts.
+# set TERRITORIALBOT_SCHEMA_CACHE to a directory to keep the generated source and bytecode there.
+# numpy is only imported for batch decoding (decode_game_frame, GAME_EVENT_DTYPE)
+
+np = None
+
+class Field:
+    def __init__(self, name, width, add=0):
+        self.name = name
+        self.width = width
+        self.add = add
+
+    def is_fixed(self):
+        return isinstance(self.width, int)
+
+class Flag(Field):
+    def __init__(self, name):
+        super().__init__(name, 1)
+
+class Array:
+    def __init__(self, name, count, width):
+        self.name = name
+        self.count = count
+        self.width = width
+
+    def is_fixed(self):
+        return isinstance(self.width, int)
+
+class String:
+    def __init__(self, name, length_bits):
+        self.name = name
+        self.length_bits = length_bits
+
+    def is_fixed(self):
+        return False
+
+class Group:
+    def __init__(self, name, count_bits, fields, add=0, index=None):
+        self.name = name
+        self.count_bits = count_bits
+        self.fields = fields
+        self.add = add
+        self.index = index
+
+    def is_fixed(self):
+        return False
+
+class Message:
+    def __init__(self, name, fields, header=(), output=dict, event_id=None):
+        self.name = name
+        self.fields = fields
+        self.header = header
+        self.output = output
+        # game events are decoded into output(event_id, sender, *fields)
+        self.event_id = event_id
+
+    def fixed_bits(self):
+        return sum(field.width * (field.count if isinstance(field, Array) else 1) for field in self.fields)
+
+def has_strings(fields):
+    return any(isinstance(field, String) or (isinstance(field, Group) and has_strings(field.fields)) for field in fields)
+
+class Compiler:
+    def __init__(self):
+        self.lines = []
+        self.counter = 0
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def temp(self, prefix):
+        self.counter += 1
+        return f"{prefix}{self.counter}"
+
+    @staticmethod
+    def local(depth, name):
+        return f"v{depth}_{name}"
+
+    @staticmethod
+    def lookup(scope, name):
+        for frame in reversed(scope):
+            if name in frame:
+                return frame[name]
+        raise KeyError(f"width refers to unknown field {name}")
+
+    # decoders
+
+    def decode_message(self, message):
+        if message.event_id != None:
+            self.emit(0, f"def decode_{message.name}(buf, sender):")
+        else:
+            self.emit(0, f"def decode_{message.name}(buf):")
+        if len(message.fields) > 0:
+            self.emit(1, "read = buf.decode_bits")
+        if has_strings(message.fields):
+            self.emit(1, "read_str = buf.read_str")
+
+        names = self.decode_fields(message.fields, 0, 1, [{}])
+
+        if message.event_id != None:
+            self.emit(1, f"return {message.output.__name__}({message.event_id}, sender" + "".join(f", {var}" for name, var in names) + ")")
+        elif message.output == dict:
+            self.emit(1, "return {" + ", ".join(f'"{name}": {var}' for name, var in names) + "}")
+        elif message.output == tuple:
+            self.emit(1, "return (" + "".join(f"{var}, " for name, var in names) + ")")
+        else:
+            self.emit(1, f"return {message.output.__name__}(" + ", ".join(var for name, var in names) + ")")
+        self.emit(0, "")
+
+    def decode_fields(self, fields, depth, indent, scope):
+        names = []
+        run = []
+
+        def flush():
+            if len(run) == 0:
+                return
+            self.decode_run(run, depth, indent)
+            for field in run:
+                var = self.local(depth, field.name)
+                scope[-1][field.name] = var
+                names.append((field.name, var))
+            run.clear()
+
+        for field in fields:
+            if field.is_fixed():
+                run.append(field)
+                continue
+
+            flush()
+            var = self.local(depth, field.name)
+
+            if isinstance(field, Group):
+                self.decode_group(field, depth, indent, scope)
+            elif isinstance(field, String):
+                self.emit(indent, f"{var} = read_str(read({field.length_bits}))")
+            elif isinstance(field, Array):
+                width = self.lookup(scope, field.width)
+                self.emit(indent, f"{var} = [" + ", ".join(f"read({width})" for i in range(field.count)) + "]")
+            else:
+                width = self.lookup(scope, field.width)
+                self.emit(indent, f"{var} = read({width})" + (f" + {field.add}" if field.add else ""))
+
+            scope[-1][field.name] = var
+            names.append((field.name, var))
+
+        flush()
+        return names
+
+    def decode_run(self, run, depth, indent):
+        total = sum(field.width * (field.count if isinstance(field, Array) else 1) for field in run)
+
+        if len(run) == 1 and not isinstance(run[0], Array):
+            packed = f"read({total})"
+            self.emit(indent, f"{self.local(depth, run[0].name)} = {self.convert(run[0], packed)}")
+            return
+
+        packed = self.temp("p")
+        self.emit(indent, f"{packed} = read({total})")
+
+        shift = total
+        for field in run:
+            mask = (1 << field.width) - 1
+            if isinstance(field, Array):
+                items = []
+                for i in range(field.count):
+                    shift -= field.width
+                    items.append(f"({packed} >> {shift}) & {mask}" if shift else f"{packed} & {mask}")
+                self.emit(indent, f"{self.local(depth, field.name)} = [" + ", ".join(items) + "]")
+            else:
+                shift -= field.width
+                if shift == 0:
+                    value = f"{packed} & {mask}" if field is not run[0] else packed
+                elif field is run[0]:
+                    value = f"{packed} >> {shift}"
+                else:
+                    value = f"({packed} >> {shift}) & {mask}"
+                self.emit(indent, f"{self.local(depth, field.name)} = {self.convert(field, value)}")
+
+    @staticmethod
+    def convert(field, value):
+        if isinstance(field, Flag):
+            return f"({value}) == 1"
+        elif field.add:
+            return f"({value}) + {field.add}"
+        return value
+
+    def decode_group(self, group, depth, indent, scope):
+        var = self.local(depth, group.name)
+        index = f"i{depth + 1}"
+        count = f"read({group.count_bits})" + (f" + {group.add}" if group.add else "")
+
+        self.emit(indent, f"{var} = []")
+        self.emit(indent, f"for {index} in range({count}):")
+
+        scope.append({})
+        names = self.decode_fields(group.fields, depth + 1, indent + 1, scope)
+        scope.pop()
+
+        items = []
+        if group.index != None:
+            items.append(f'"{group.index}": {index}')
+        items += [f'"{name}": {item_var}' for name, item_var in names]
+        self.emit(indent + 1, f"{var}.append({{" + ", ".join(items) + "})")
+
+    # encoders
+
+    def pack_message(self, message):
+        self.emit(0, f"def pack_{message.name}(msg):")
+        self.emit(1, "acc = 0")
+        self.emit(1, "bits = 0")
+
+        # events are packed from their tuples, skipping id and sender
+        if message.output == dict:
+            positional = None
+        else:
+            positional = 2 if message.event_id != None else 0
+        self.pack_fields(message.fields, 0, 1, "msg", positional)
+        self.emit(1, "return bits, acc")
+        self.emit(0, "")
+
+        if len(message.header) == 0:
+            return
+
+        header_bits = sum(width for width, value in message.header)
+        header_value = 0
+        for width, value in message.header:
+            header_value = (header_value << width) | value
+
+        self.emit(0, f"def encode_{message.name}(msg):")
+        self.emit(1, f"bits, acc = pack_{message.name}(msg)")
+        self.emit(1, f"bits += {header_bits}")
+        self.emit(1, f"acc |= {header_value} << (bits - {header_bits})")
+        self.emit(1, "size = (bits + 7) >> 3")
+        self.emit(1, "return (acc << ((size << 3) - bits)).to_bytes(size, 'big')")
+        self.emit(0, "")
+
+    def pack_fields(self, fields, depth, indent, source, positional):
+        for position, field in enumerate(fields):
+            var = self.local(depth, field.name)
+            if positional != None:
+                self.emit(indent, f"{var} = {source}[{positional + position}]")
+            else:
+                self.emit(indent, f'{var} = {source}["{field.name}"]')
+
+            if isinstance(field, Group):
+                item = f"item{depth + 1}"
+                count = f"len({var}) - {field.add}" if field.add else f"len({var})"
+                self.emit(indent, f"acc = (acc << {field.count_bits}) | ({count})")
+                self.emit(indent, f"bits += {field.count_bits}")
+                self.emit(indent, f"for {item} in {var}:")
+                self.pack_fields(field.fields, depth + 1, indent + 1, item, None)
+            elif isinstance(field, String):
+                self.emit(indent, f"acc = (acc << {field.length_bits}) | len({var})")
+                self.emit(indent, f"bits += {field.length_bits} + 16 * len({var})")
+                self.emit(indent, f"for char in {var}:")
+                self.emit(indent + 1, "acc = (acc << 16) | (ord(char) & 65535)")
+            elif isinstance(field, Array):
+                width, mask = self.width_expr(field.width)
+                self.emit(indent, f"for value in {var}:")
+                self.emit(indent + 1, f"acc = (acc << {width}) | (value & {mask})")
+                self.emit(indent, f"bits += {width} * len({var})")
+            else:
+                width, mask = self.width_expr(field.width)
+                value = f"int({var})" if isinstance(field, Flag) else (f"({var} - {field.add})" if field.add else var)
+                self.emit(indent, f"acc = (acc << {width}) | ({value} & {mask})")
+                self.emit(indent, f"bits += {width}")
+
+    def width_expr(self, width):
+        if isinstance(width, int):
+            return str(width), str((1 << width) - 1)
+        # widths can only refer to top level fields that were packed before
+        return self.local(0, width), f"((1 << {self.local(0, width)}) - 1)"
+
+def generate_source(messages):
+    compiler = Compiler()
+    for message in messages:
+        compiler.decode_message(message)
+        compiler.pack_message(message)
+    return "\n".join(compiler.lines)
+
+def compile_messages(messages, namespace, cache_dir=None):
+    source = generate_source(messages)
+
+    code = None
+    if cache_dir != None:
+        key = hashlib.sha1((source + sys.version).encode()).hexdigest()[:16]
+        path = os.path.join(cache_dir, f"protocol_{key}")
+        try:
+            with open(path + ".bin", "rb") as cached:
+                code = marshal.load(cached)
+        except (OSError, ValueError, EOFError):
+            code = compile(source, path + ".py", "exec")
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(path + ".py", "w") as cached:
+                    cached.write(source)
+                with open(path + ".bin", "wb") as cached:
+                    marshal.dump(code, cached)
+            except OSError:
+                pass
+    else:
+        code = compile(source, "<protocol>", "exec")
+
+    scope = {message.output.__name__: message.output for message in messages if message.output not in (dict, tuple)}
+    exec(code, scope)
+    for message in messages:
+        for prefix in ("decode_", "pack_", "encode_"):
+            if prefix + message.name in scope:
+                namespace[prefix + message.name] = scope[prefix + message.name]
+
+# lobby state, event 2
+LOBBY_UPDATE = Message("lobby_update", header=((1, 0), (6, 2)), fields=[
+    Field("online_bits", 6),
+    Array("online", 4, "online_bits"),
+    Group("battles", 4, [
+        Field("id", 5),
+        Field("gamemode", 4),
+        Flag("crown"),
+        Field("mapId", 6),
+        Field("seed", 14),
+        Field("players", "online_bits"),
+        Field("maxPlayers", 9, add=1),
+        Field("time", 10),
+        Group("clans", 3, [
+            Field("online", 9, add=1),
+            String("clan", 3),
+        ]),
+    ]),
+])
+
+# game scene with players roster, event 3. localPlayerId doubles as challengeY
+GAME_SCENE = Message("game_scene", header=((1, 0), (6, 3)), fields=[
+    Field("index", 10),
+    Field("challengeX", 10),
+    Field("localPlayerId", 9),
+    Field("uY", 14),
+    Field("ua", 4),
+    Flag("a4V"),
+    Field("a4W", 6),
+    Field("a4X", 14),
+    Group("players", 9, add=1, index="id", fields=[
+        Field("flag", 1),
+        Array("colors", 3, 6),
+        String("nickname", 5),
+    ]),
+])
+
+# the scene up to the roster, the client reads the players into a roster.Roster
+GAME_SCENE_HEAD = Message("game_scene_head", fields=GAME_SCENE.fields[:-1])
+
+# game server switch without roster, event 4
+GAME_SERVER = Message("game_server", header=((1, 0), (6, 4)), fields=[
+    Field("index", 10),
+    Field("challengeX", 10),
+    Field("challengeY", 1),
+])
+
+# game events, each one is a 4 bit id and 9 bit sender followed by a fixed size payload
+PlaceBase = namedtuple("PlaceBase", "id sender pos")
+Attack = namedtuple("Attack", "id sender percentage target")
+SendMoney = namedtuple("SendMoney", "id sender value target")
+PositionEvent = namedtuple("PositionEvent", "id sender value pos")
+Emoji = namedtuple("Emoji", "id sender emoji")
+FlagEvent = namedtuple("FlagEvent", "id sender flag")
+PlayerLeft = namedtuple("PlayerLeft", "id sender")
+GameEvent = namedtuple("GameEvent", "id sender")
+
+# private events come in their own frame, addressed to this client only
+PrivateEmoji = namedtuple("PrivateEmoji", "id sender emoji")
+ClanRequest = namedtuple("ClanRequest", "id sender")
+PrivateTarget = namedtuple("PrivateTarget", "id sender target")
+
+GAME_EVENTS = {
+    0: Message("place_base", event_id=0, output=PlaceBase, fields=[Field("pos", 22)]),
+    1: Message("attack", event_id=1, output=Attack, fields=[Field("percentage", 10), Field("target", 10)]),
+    2: Message("send_money", event_id=2, output=SendMoney, fields=[Field("value", 10), Field("target", 9)]),
+    3: Message("position_3", event_id=3, output=PositionEvent, fields=[Field("value", 10), Field("pos", 22)]),
+    4: Message("position_4", event_id=4, output=PositionEvent, fields=[Field("value", 10), Field("pos", 22)]),
+    5: Message("emoji_5", event_id=5, output=Emoji, fields=[Field("emoji", 10)]),
+    6: Message("emoji_6", event_id=6, output=Emoji, fields=[Field("emoji", 10)]),
+    7: Message("flag_7", event_id=7, output=FlagEvent, fields=[Field("flag", 1)]),
+    9: Message("player_left", event_id=9, output=PlayerLeft, fields=[]),
+}
+
+PRIVATE_EVENTS = {
+    12: Message("private_emoji", event_id=12, output=PrivateEmoji, fields=[Field("emoji", 10)]),
+    13: Message("clan_request", event_id=13, output=ClanRequest, fields=[]),
+    14: Message("private_target", event_id=14, output=PrivateTarget, fields=[Field("target", 9)]),
+}
+
+MESSAGES = [LOBBY_UPDATE, GAME_SCENE, GAME_SCENE_HEAD, GAME_SERVER] + list(GAME_EVENTS.values()) + list(PRIVATE_EVENTS.values())
+
+compile_messages(MESSAGES, globals(), os.environ.get("TERRITORIALBOT_SCHEMA_CACHE"))
+
+def event_table(events):
+    sizes = [0] * 16
+    decoders = [None] * 16
+    packers = [None] * 16
+    for event_id, message in events.items():
+        sizes[event_id] = message.fixed_bits()
+        decoders[event_id] = globals()["decode_" + message.name]
+        packers[event_id] = globals()["pack_" + message.name]
+
+    # unknown ids carry no payload, same as the game client treats them
+    for event_id in range(16):
+        if decoders[event_id] == None:
+            decoders[event_id] = lambda buf, sender, event_id=event_id: GameEvent(event_id, sender)
+    return sizes, decoders, packers
+
+GAME_EVENT_SIZES, GAME_EVENT_DECODERS, GAME_EVENT_PACKERS = event_table(GAME_EVENTS)
+PRIVATE_EVENT_SIZES, PRIVATE_EVENT_DECODERS, PRIVATE_EVENT_PACKERS = event_table(PRIVATE_EVENTS)
+
+# anything longer is certainly a broadcast frame
+PRIVATE_FRAME_MAX_BITS = (13 + max(PRIVATE_EVENT_SIZES) + 7) // 8 * 8
+
+# walks the event headers of a game frame without decoding payloads and returns
+# the bit offset of every event, or None when the frame does not parse as a
+# broadcast stream, which means it is a private event
+def split_game_frame(buf):
+    size = buf.size_bits
+    offsets = []
+    offset = 2
+    while offset + 8 <= size:
+        if offset + 13 > size:
+            return None
+        buf.read_offset = offset
+        offsets.append(offset)
+        offset += 13 + GAME_EVENT_SIZES[buf.decode_bits(4)]
+        if offset > size:
+            return None
+    return offsets
+
+def batch_tables(np):
+    widths_a = np.zeros(16, dtype=np.int64)
+    widths_b = np.zeros(16, dtype=np.int64)
+    for event_id, message in GAME_EVENTS.items():
+        if len(message.fields) > 0:
+            widths_a[event_id] = message.fields[0].width
+        if len(message.fields) > 1:
+            widths_b[event_id] = message.fields[1].width
+
+    widest = max(int(widths_a.max()), int(widths_b.max()), 9)
+    # weights[w] turns a window of bits into the value of its first w bits
+    weights = np.zeros((widest + 1, widest), dtype=np.int64)
+    for width in range(1, widest + 1):
+        weights[width, :width] = 1 << np.arange(width - 1, -1, -1)
+    return np.array(GAME_EVENT_SIZES, dtype=np.int64), widths_a, widths_b, weights
+
+BATCH_NAMES = ("GAME_EVENT_DTYPE", "BATCH_SIZES", "BATCH_WIDTHS_A", "BATCH_WIDTHS_B", "BATCH_WEIGHTS")
+
+def load_numpy():
+    global np, GAME_EVENT_DTYPE, BATCH_SIZES, BATCH_WIDTHS_A, BATCH_WIDTHS_B, BATCH_WEIGHTS
+    if np != None:
+        return
+    import numpy
+    # columnar form of a game frame, one row per event. a and b are the first and
+    # second payload fields of the event (pos, percentage/target, value/target, emoji...)
+    GAME_EVENT_DTYPE = numpy.dtype([("id", numpy.uint8), ("sender", numpy.uint16), ("a", numpy.uint32), ("b", numpy.uint32)])
+    BATCH_SIZES, BATCH_WIDTHS_A, BATCH_WIDTHS_B, BATCH_WEIGHTS = batch_tables(numpy)
+    # set last, other threads take np != None as the tables being ready
+    np = numpy
+
+# the batch tables appear on first access
+def __getattr__(name):
+    if name in BATCH_NAMES:
+        load_numpy()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def read_columns(bits, starts, widths):
+    window = bits[starts[:, None] + np.arange(BATCH_WEIGHTS.shape[1])]
+    return (window * BATCH_WEIGHTS[widths]).sum(axis=1)
+
+# decodes a whole broadcast frame at once. event boundaries depend on the ids before them,
+# so instead of walking the frame every bit position gets the offset of the event that would
+# follow it and the chain starting at bit 2 is found by pointer doubling in log(n) steps.
+# returns None for private event frames, like split_game_frame
+def decode_game_frame(data, offsets=None):
+    if np == None:
+        load_numpy()
+    raw = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    size = raw.size
+    bits = np.zeros(size + BATCH_WEIGHTS.shape[1] + 13, dtype=np.int64)
+    bits[:size] = raw
+
+    if offsets != None:
+        starts = np.array(offsets, dtype=np.int64)
+    elif size < 10:
+        starts = np.zeros(0, dtype=np.int64)
+    else:
+        positions = np.arange(size, dtype=np.int64)
+        ids = (bits[:size] << 3) | (bits[1:size + 1] << 2) | (bits[2:size + 2] << 1) | bits[3:size + 3]
+        following = positions + 13 + BATCH_SIZES[ids]
+        has_event = positions + 8 <= size
+
+        # position size is the end of the chain
+        jump = np.full(size + 1, size, dtype=np.int64)
+        jump[:size][has_event] = np.minimum(following[has_event], size)
+        truncated = has_event & (following > size)
+
+        reached = np.zeros(size + 1, dtype=bool)
+        reached[2] = True
+        steps = 1
+        while steps < size:
+            reached[jump[reached]] = True
+            jump = jump[jump]
+            steps *= 2
+
+        starts = np.flatnonzero(reached[:size] & has_event)
+        if truncated[starts].any():
+            return None
+
+    ids = (bits[starts] << 3) | (bits[starts + 1] << 2) | (bits[starts + 2] << 1) | bits[starts + 3]
+    events = np.empty(starts.size, dtype=GAME_EVENT_DTYPE)
+    events["id"] = ids
+    events["sender"] = read_columns(bits, starts + 4, np.full(starts.size, 9))
+    widths_a = BATCH_WIDTHS_A[ids]
+    events["a"] = read_columns(bits, starts + 13, widths_a)
+    events["b"] = read_columns(bits, starts + 13 + widths_a, BATCH_WIDTHS_B[ids])
+    return events
+
+# broadcast game frame: 1 bit set, 1 bit tick parity, then events until less than a byte is left
+def encode_game_frame(events, parity=0):
+    acc = 2 | parity
+    bits = 2
+    for event in events:
+        event_id = event[0]
+        acc = (acc << 13) | (event_id << 9) | event[1]
+        bits += 13
+        packer = GAME_EVENT_PACKERS[event_id]
+        if packer != None:
+            payload_bits, value = packer(event)
+            acc = (acc << payload_bits) | value
+            bits += payload_bits
+    size = (bits + 7) >> 3
+    return (acc << ((size << 3) - bits)).to_bytes(size, "big")
+
+def encode_private_event(event):
+    event_id = event[0]
+    acc = (event_id << 9) | event[1]
+    bits = 13
+    packer = PRIVATE_EVENT_PACKERS[event_id]
+    if packer != None:
+        payload_bits, value = packer(event)
+        acc = (acc << payload_bits) | value
+        bits += payload_bits
+    size = (bits + 7) >> 3
+    return (acc << ((size << 3) - bits)).to_bytes(size, "big")
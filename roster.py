@@ -0,0 +1,131 @@
+from array import array
+import sys
+
+# players roster of a game scene (event 3), kept in columns next to the frame it came from.
+# the scene is walked once for the fixed fields and the bit offset of every nickname,
+# nicknames are only decoded when asked for. decoded names are interned for the whole
+# process, clients in the same room get the same string objects without decoding again
+
+NAMES = {}
+NAMES_LIMIT = 100000
+
+def decode_name(length, value):
+    key = (length, value)
+    name = NAMES.get(key)
+    if name == None:
+        if len(NAMES) >= NAMES_LIMIT:
+            NAMES.clear()
+        name = NAMES[key] = sys.intern(value.to_bytes(length * 2, "big").decode("utf-16-be", "surrogatepass"))
+    return name
+
+# same key as the roster stores, so a lookup does not decode any nickname
+def name_key(nickname):
+    data = nickname.encode("utf-16-be", "surrogatepass")
+    return len(data) // 2, int.from_bytes(data, "big")
+
+class Roster:
+    # buf is positioned at the players count of a game scene, None gives an empty roster
+    def __init__(self, buf=None):
+        self.flags = array("B")
+        self.colors = array("B")
+        self.offsets = array("I")
+        self.lengths = array("B")
+        self.alive = bytearray()
+        self.index = None
+        self.duplicates = {}
+        self.view = None
+        self.size_bits = 0
+        if buf == None:
+            return
+
+        self.view = buf.view
+        self.size_bits = buf.size_bits
+        read = buf.decode_bits
+        for i in range(read(9) + 1):
+            # flag, three 6 bit colors and the nickname length in one read
+            fields = read(24)
+            length = fields & 31
+            self.flags.append(fields >> 23)
+            self.colors.extend(((fields >> 17) & 63, (fields >> 11) & 63, (fields >> 5) & 63))
+            self.offsets.append(buf.read_offset)
+            self.lengths.append(length)
+            buf.read_offset += 16 * length
+        self.alive = bytearray(b"\x01") * len(self.lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    # the nickname as (length, 16 bit chars packed into one int), read straight from the frame
+    def key(self, id, length=None):
+        length = self.lengths[id] if length == None else length
+        offset = self.offsets[id]
+        end = offset + 16 * length
+        start = offset >> 3
+        stop = (end + 7) >> 3
+        return length, (int.from_bytes(self.view[start:stop], "big") >> ((stop << 3) - end)) & ((1 << (16 * length)) - 1)
+
+    def nickname(self, id):
+        length = self.lengths[id]
+        if self.offsets[id] + 16 * length <= self.size_bits:
+            return decode_name(*self.key(id))
+
+        # truncated scene, keep the readable part and mark the rest
+        readable = max(0, (self.size_bits - self.offsets[id]) // 16)
+        return decode_name(*self.key(id, readable)) + "?" * (length - readable)
+
+    # id of the first player still in the game with this nickname, None if there is none
+    def find(self, nickname):
+        if self.index == None:
+            index = {}
+            for id in range(len(self.lengths)):
+                if self.alive[id]:
+                    key = self.key(id)
+                    if key in index:
+                        self.duplicates.setdefault(key, []).append(id)
+                    else:
+                        index[key] = id
+            self.index = index
+        return self.index.get(name_key(nickname))
+
+    # player left the game (event 9)
+    def leave(self, id):
+        if id >= len(self.alive) or not self.alive[id]:
+            return
+        self.alive[id] = 0
+        if self.index != None:
+            key = self.key(id)
+            if self.index.get(key) == id:
+                del self.index[key]
+                # a player with the same nickname may still be there
+                for other in self.duplicates.pop(key, ()):
+                    if self.alive[other]:
+                        if key in self.index:
+                            self.duplicates.setdefault(key, []).append(other)
+                        else:
+                            self.index[key] = other
+
+    def player(self, id):
+        return {
+            "id": id,
+            "flag": self.flags[id],
+            "colors": self.colors[id * 3:id * 3 + 3].tolist(),
+            "nickname": self.nickname(id),
+        }
+
+    # dict per player like the eager decoder returned, nicknames get decoded
+    def __getitem__(self, id):
+        if id < 0:
+            id += len(self.lengths)
+        if id < 0 or id >= len(self.lengths):
+            raise IndexError("player id out of range")
+        return self.player(id)
+
+    def __iter__(self):
+        for id in range(len(self.lengths)):
+            yield self.player(id)
+
+    def stats(self):
+        return {"players": len(self.lengths), "alive": sum(self.alive), "interned_names": len(NAMES)}
+
+# roster of clients that did not join a game yet, shared since nothing changes it
+EMPTY = Roster()
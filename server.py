@@ -0,0 +1,394 @@
+import argparse
+import asyncio
+import random
+import ssl
+import time
+
+import aiows
+import protocol
+import territorialbot
+
+# local stand-in for the lobby and game servers, speaks the same bit protocol as territorialbot.Client.
+# one port serves both: lobby sessions send session info after the challenge, game sessions send
+# ready for session. point clients at it with
+#   Client(nick, lobby_address=server.lobby_address, game_address=server.game_address)
+#
+#   python server.py --port 8765 --room-size 8 --start-delay 2
+
+# game actions sent by clients, first bit 1 and a 4 bit id. the public ones come back to the whole
+# room as game events, the private ones are delivered to a single recipient
+PUBLIC_ACTIONS = {
+    0: ((22,), lambda sender, pos: protocol.PlaceBase(0, sender, pos)),
+    1: ((10, 10), lambda sender, percentage, target: protocol.Attack(1, sender, percentage, target)),
+    2: ((10, 9), lambda sender, value, target: protocol.SendMoney(2, sender, value, target)),
+    3: ((10, 22), lambda sender, value, pos: protocol.PositionEvent(3, sender, value, pos)),
+    4: ((10, 22), lambda sender, value, pos: protocol.PositionEvent(4, sender, value, pos)),
+    5: ((10,), lambda sender, emoji: protocol.Emoji(5, sender, emoji)),
+    6: ((10,), lambda sender, emoji: protocol.Emoji(6, sender, emoji)),
+    7: ((1,), lambda sender, flag: protocol.FlagEvent(7, sender, flag)),
+}
+
+# (recipient first) -> private event
+PRIVATE_ACTIONS = {
+    12: ((9, 10), lambda sender, emoji: protocol.PrivateEmoji(12, sender, emoji)),
+    14: ((9,), lambda sender: protocol.ClanRequest(13, sender)),
+    15: ((9, 9), lambda sender, target: protocol.PrivateTarget(14, sender, target)),
+}
+
+class Player:
+    def __init__(self, nickname, colors):
+        self.nickname = nickname
+        self.colors = colors
+        self.id = None
+        self.room = None
+        self.lobby_ws = None
+        self.ws = None
+
+class Room:
+    def __init__(self, id, max_players):
+        self.id = id
+        self.max_players = max_players
+        self.seed = random.randint(0, (1 << 14) - 1)
+        self.map_id = random.randint(0, 63)
+        self.created = time.monotonic()
+        self.players = []
+        self.first_join = None
+
+        # filled in when the room starts
+        self.index = None
+        self.challenge_x = None
+        self.started = None
+        self.events = []
+        self.parity = 0
+        self.task = None
+
+class Server:
+    def __init__(self, host="127.0.0.1", port=0, rooms=4, max_players=512, room_size=None, start_delay=1.0,
+            tick=0.1, lobby_interval=0.5, verify_challenges=True, logging=False, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.rooms_count = min(rooms, 15)
+        self.max_players = max_players
+        self.room_size = room_size or max_players
+        self.start_delay = start_delay
+        self.tick = tick
+        self.lobby_interval = lobby_interval
+        self.verify_challenges = verify_challenges
+        self.logging = logging
+
+        self.rooms = [Room(i, max_players) for i in range(self.rooms_count)]
+        self.games = {}
+        self.lobby_sessions = set()
+        self.lobby_dirty = True
+        self.next_index = 0
+
+        self.connections = 0
+        self.challenges_failed = 0
+        self.games_started = 0
+        self.frames_broadcast = 0
+
+        self.server = None
+        self.tasks = []
+
+    @property
+    def scheme(self):
+        return "wss" if self.ssl_context != None else "ws"
+
+    @property
+    def lobby_address(self):
+        return f"{self.scheme}://{self.host}:{self.port}/i31/"
+
+    # format string for Client(game_address=...)
+    @property
+    def game_address(self):
+        return f"{self.scheme}://{self.host}:{self.port}/i3{{index}}/"
+
+    async def start(self):
+        self.server = await aiows.serve(self.handle, self.host, self.port, self.ssl_context)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.tasks.append(asyncio.ensure_future(self.lobby_loop()))
+        return self
+
+    async def serve_forever(self):
+        if self.server == None:
+            await self.start()
+        await self.server.serve_forever()
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for room in self.games.values():
+            if room.task != None:
+                room.task.cancel()
+        if self.server != None:
+            self.server.close()
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "lobby_sessions": len(self.lobby_sessions),
+            "waiting": sum(len(room.players) for room in self.rooms),
+            "games": len(self.games),
+            "games_started": self.games_started,
+            "challenges_failed": self.challenges_failed,
+            "frames_broadcast": self.frames_broadcast,
+        }
+
+    async def handle(self, ws):
+        self.connections += 1
+        player = None
+        challenge = None
+        verified = False
+
+        try:
+            while True:
+                message = await ws.recv()
+                if isinstance(message, str) or len(message) == 0:
+                    continue
+
+                buf = territorialbot.Buffer(data=message)
+                if buf.decode_bits(1) == 1:
+                    if player != None and player.ws is ws:
+                        self.on_action(player, buf)
+                    continue
+
+                event_id = buf.decode_bits(6)
+                if event_id == 13:
+                    challenge = self.send_challenge(ws)
+                elif event_id == 14:
+                    x, y = buf.read_fields((3, 16))
+                    if challenge == None or (self.verify_challenges and (x, y) != challenge):
+                        self.challenges_failed += 1
+                        ws.close()
+                        return
+                    verified = True
+                elif event_id == 1 and verified:
+                    player = self.on_session_info(ws, buf)
+                elif event_id == 2 and player != None:
+                    self.on_join_room(player, buf.decode_bits(4))
+                elif event_id == 5 and verified:
+                    player = self.on_ready(ws, buf)
+                    if player == None:
+                        ws.close()
+                        return
+        except (aiows.ConnectionClosed, IndexError):
+            pass
+        finally:
+            self.lobby_sessions.discard(ws)
+            if player != None:
+                self.on_disconnect(player, ws)
+
+    def send_challenge(self, ws):
+        x = random.randint(0, 7)
+        y1 = random.randint(16384, 65535)
+        y2 = random.randint(1 << 18, (1 << 20) - 1)
+
+        buf = territorialbot.Buffer(territorialbot.Buffer.bits_to_bytes(46))
+        buf.write_fields((1, 6, 3, 16, 20), (0, 9, x, y1, y2))
+        ws.send_binary(bytes(buf.buffer))
+
+        if self.verify_challenges:
+            return x, territorialbot.solve_challenge(y1, y2)
+        return x, None
+
+    def on_session_info(self, ws, buf):
+        buf.decode_bits(10)
+        nickname = buf.read_str(buf.decode_bits(5))
+        colors = buf.read_fields((6, 6, 6))
+
+        player = Player(nickname, colors)
+        player.lobby_ws = ws
+        self.lobby_sessions.add(ws)
+        ws.send_binary(self.lobby_update())
+        return player
+
+    def on_join_room(self, player, id):
+        if id >= len(self.rooms) or player.id != None:
+            return
+
+        room = self.rooms[id]
+        if player in room.players:
+            return
+        for other in self.rooms:
+            if player in other.players:
+                other.players.remove(player)
+
+        room.players.append(player)
+        if room.first_join == None:
+            room.first_join = time.monotonic()
+        self.lobby_dirty = True
+
+        if len(room.players) >= min(self.room_size, room.max_players):
+            self.start_room(room)
+
+    def start_room(self, room):
+        self.rooms[room.id] = Room(room.id, self.max_players)
+        self.lobby_dirty = True
+
+        room.index = self.next_index
+        self.next_index = (self.next_index + 1) % 1024
+        room.challenge_x = room.index
+        room.started = time.monotonic()
+        self.games[room.challenge_x] = room
+        self.games_started += 1
+
+        roster = [{"flag": 0, "colors": player.colors, "nickname": player.nickname[:31]} for player in room.players]
+        for id, player in enumerate(room.players):
+            player.id = id
+            player.room = room
+            self.lobby_sessions.discard(player.lobby_ws)
+            player.lobby_ws.send_binary(protocol.encode_game_scene({
+                "index": room.index,
+                "challengeX": room.challenge_x,
+                "localPlayerId": id,
+                "uY": room.seed,
+                "ua": 0,
+                "a4V": False,
+                "a4W": room.map_id,
+                "a4X": room.seed,
+                "players": roster,
+            }))
+
+        room.task = asyncio.ensure_future(self.game_loop(room))
+        if self.logging:
+            print("[ROOM STARTED]", room.index, "players:", len(room.players))
+
+    def on_ready(self, ws, buf):
+        _, challenge_x, player_id, _, _ = buf.read_fields((8, 10, 9, 10, 14))
+        room = self.games.get(challenge_x)
+        if room == None or player_id >= len(room.players):
+            return None
+
+        player = room.players[player_id]
+        player.ws = ws
+        return player
+
+    def on_action(self, player, buf):
+        action_id = buf.decode_bits(4)
+
+        if action_id in PUBLIC_ACTIONS:
+            widths, make = PUBLIC_ACTIONS[action_id]
+            player.room.events.append(make(player.id, *buf.read_fields(widths)))
+        elif action_id in PRIVATE_ACTIONS:
+            widths, make = PRIVATE_ACTIONS[action_id]
+            recipient, *values = buf.read_fields(widths)
+            players = player.room.players
+            if recipient < len(players) and players[recipient].ws != None:
+                players[recipient].ws.send_binary(protocol.encode_private_event(make(player.id, *values)))
+
+    def on_disconnect(self, player, ws):
+        for room in self.rooms:
+            if player in room.players:
+                room.players.remove(player)
+                self.lobby_dirty = True
+
+        if player.room != None and player.ws is ws:
+            player.ws = None
+            player.room.events.append(protocol.PlayerLeft(9, player.id))
+
+    # broadcast frame of every started room, one per tick with all actions received meanwhile
+    async def game_loop(self, room):
+        attached = False
+        while True:
+            await asyncio.sleep(self.tick)
+
+            players = [player for player in room.players if player.ws != None]
+            attached = attached or len(players) > 0
+            # everybody left, or nobody showed up on the game server
+            if len(players) == 0 and (attached or time.monotonic() - room.started > 30):
+                del self.games[room.challenge_x]
+                return
+            if len(room.events) == 0:
+                continue
+
+            events, room.events = room.events, []
+            # frame is encoded once and written as is to every socket
+            frame = aiows.encode_frame(aiows.OPCODE_BINARY, protocol.encode_game_frame(events, room.parity), False)
+            room.parity ^= 1
+            for player in players:
+                try:
+                    player.ws.send_raw(frame)
+                except aiows.ConnectionClosed:
+                    pass
+            self.frames_broadcast += 1
+
+    def lobby_update(self):
+        waiting = sum(len(room.players) for room in self.rooms)
+        online = [len(self.lobby_sessions), waiting, len(self.games), 0]
+        online_bits = max(max(online).bit_length(), 1)
+        now = time.monotonic()
+
+        return protocol.encode_lobby_update({
+            "online_bits": online_bits,
+            "online": online,
+            "battles": [{
+                "id": room.id,
+                "gamemode": 0,
+                "crown": 0,
+                "mapId": room.map_id,
+                "seed": room.seed,
+                "players": len(room.players),
+                "maxPlayers": room.max_players,
+                "time": min(int(now - room.created), 1023),
+                "clans": [],
+            } for room in self.rooms],
+        })
+
+    # waiting rooms are started by their delay here, lobby updates go out at most once per interval
+    async def lobby_loop(self):
+        while True:
+            await asyncio.sleep(min(self.lobby_interval, self.start_delay or self.lobby_interval))
+
+            now = time.monotonic()
+            for room in list(self.rooms):
+                if self.start_delay != None and room.first_join != None and now - room.first_join >= self.start_delay:
+                    self.start_room(room)
+
+            if self.lobby_dirty and len(self.lobby_sessions) > 0:
+                self.lobby_dirty = False
+                frame = aiows.encode_frame(aiows.OPCODE_BINARY, self.lobby_update(), False)
+                for ws in list(self.lobby_sessions):
+                    try:
+                        ws.send_raw(frame)
+                    except aiows.ConnectionClosed:
+                        self.lobby_sessions.discard(ws)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--max-players", type=int, default=512)
+    parser.add_argument("--room-size", type=int, default=None)
+    parser.add_argument("--start-delay", type=float, default=1.0)
+    parser.add_argument("--tick", type=float, default=0.1)
+    parser.add_argument("--no-verify", action="store_true")
+    parser.add_argument("--logging", action="store_true")
+    parser.add_argument("--certfile", default=None, help="serve wss:// with this certificate")
+    parser.add_argument("--keyfile", default=None)
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.certfile != None:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.certfile, args.keyfile)
+
+    server = Server(args.host, args.port, args.rooms, args.max_players, args.room_size, args.start_delay,
+        args.tick, verify_challenges=not args.no_verify, logging=args.logging, ssl_context=ssl_context)
+
+    async def run():
+        await server.start()
+        # first line is the port, so scripts can start the server with --port 0
+        print(server.port, flush=True)
+        if args.logging:
+            print("lobby:", server.lobby_address, "game:", server.game_address)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
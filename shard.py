@@ -0,0 +1,348 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import struct
+import time
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock, Thread
+
+import swarm
+import territorialbot
+
+# runs a swarm split over worker processes, one swarm.Swarm per shard, so decoding and
+# challenge work use every core. the leader process sends commands to all shards through
+# a ring buffer in shared memory and gets their status back through a queue.
+#
+#   bots = shard.ShardedSwarm(make_bot, 2000, shards=8)
+#   bots.start()
+#   bots.attack(200, target)
+#   bots.status()
+#   bots.stop()
+#
+# the shards are started with spawn, so the factory must be importable from the worker,
+# a module level function or a functools.partial of one. inside a shard shard.current
+# is the running ShardWorker, factories can reach its swarm through it
+
+# ring layout: u64 last written sequence, then slots of
+#   u64 sequence, u64 time.monotonic_ns() of the write, u8 command, u16 shard, i32 a, b, c
+# one writer, any number of readers, each reader keeps its own position
+HEADER = struct.Struct("<Q")
+SLOT = struct.Struct("<QQBxHiii")
+SEQUENCE = struct.Struct("<Q")
+
+STOP = 0
+ATTACK = 1
+MONEY = 2
+SET_BASE = 3
+CLAN_REQUEST = 4
+
+ALL = 0xFFFF
+
+current = None
+
+class CommandRing:
+    def __init__(self, name=None, slots=4096):
+        if name == None:
+            self.memory = SharedMemory(create=True, size=HEADER.size + slots * SLOT.size)
+            self.memory.buf[:HEADER.size] = bytes(HEADER.size)
+            self.owner = True
+        else:
+            # shards share the resource tracker of the leader, it unlinks the segment
+            # only if the leader goes away without close()
+            self.memory = SharedMemory(name=name)
+            self.owner = False
+
+        self.name = self.memory.name
+        self.buf = self.memory.buf
+        self.slots = (len(self.buf) - HEADER.size) // SLOT.size
+        self.lock = Lock()
+        # readers start at the current end, commands sent before they attached are not replayed
+        self.position = HEADER.unpack_from(self.buf, 0)[0]
+        self.lost = 0
+
+    def put(self, command, a=0, b=0, c=0, shard=ALL):
+        with self.lock:
+            sequence = self.position + 1
+            offset = HEADER.size + (sequence % self.slots) * SLOT.size
+            # sequence 0 marks the slot as being written, readers skip it
+            SLOT.pack_into(self.buf, offset, 0, time.monotonic_ns(), command, shard, a, b, c)
+            SEQUENCE.pack_into(self.buf, offset, sequence)
+            HEADER.pack_into(self.buf, 0, sequence)
+            self.position = sequence
+        return sequence
+
+    # commands written since the last read as (command, shard, a, b, c, sent_ns)
+    def read(self):
+        last = HEADER.unpack_from(self.buf, 0)[0]
+        if last == self.position:
+            return ()
+
+        if last - self.position > self.slots:
+            # the writer went around the ring, the oldest commands are gone
+            self.lost += last - self.position - self.slots
+            self.position = last - self.slots
+
+        commands = []
+        while self.position < last:
+            sequence = self.position + 1
+            offset = HEADER.size + (sequence % self.slots) * SLOT.size
+            written, sent, command, shard, a, b, c = SLOT.unpack_from(self.buf, offset)
+            # checked again after the copy, the slot may have been reused while reading
+            if written != sequence or SEQUENCE.unpack_from(self.buf, offset)[0] != sequence:
+                self.lost += 1
+            else:
+                commands.append((command, shard, a, b, c, sent))
+            self.position = sequence
+        return commands
+
+    def close(self):
+        self.buf = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+ACTIONS = {
+    ATTACK: lambda a, b, c: swarm.attack_action(a, b),
+    MONEY: lambda a, b, c: swarm.money_action(a, b),
+    SET_BASE: lambda a, b, c: swarm.set_base_action(a),
+    CLAN_REQUEST: lambda a, b, c: swarm.clan_request_action(a),
+}
+
+# the swarm of one shard, runs in its own process
+class ShardWorker:
+    def __init__(self, shard, first, count, factory, ring_name, status_queue, proxy_options=None, asynchronous=False, report_interval=1, idle_sleep=0.0005, swarm_options=None):
+        self.shard = shard
+        self.first = first
+        self.factory = factory
+        self.ring = CommandRing(ring_name)
+        self.status_queue = status_queue
+        self.asynchronous = asynchronous
+        self.report_interval = report_interval
+        self.idle_sleep = idle_sleep
+        self.launched = False
+        self.running = True
+
+        self.commands = 0
+        self.latency = territorialbot.Histogram()
+        self.last_latency = None
+        self.max_latency = 0
+
+        # proxies are handed out by global bot index, the same as one big swarm would
+        proxy_options = proxy_options or [None]
+        shift = first % len(proxy_options)
+        self.swarm = swarm.Swarm(self.create_client, count, proxy_options=proxy_options[shift:] + proxy_options[:shift], **(swarm_options or {}))
+
+    def create_client(self, index, proxy_options):
+        return self.factory(self.first + index, proxy_options)
+
+    def apply(self, command, shard, a, b, c, sent):
+        if shard != ALL and shard != self.shard:
+            return
+        if command == STOP:
+            self.running = False
+            return
+
+        latency = (time.monotonic_ns() - sent) / 1e9
+        self.latency.observe(latency)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.commands += 1
+
+        action = ACTIONS.get(command)
+        if action != None:
+            self.swarm.broadcast(action(a, b, c))
+
+    def poll(self):
+        commands = self.ring.read()
+        for command in commands:
+            self.apply(*command)
+        return len(commands) > 0
+
+    def status(self):
+        connected = self.swarm.connected()
+        phases = {phase: sum(1 for client in connected if phase in client.phase_times) for phase in swarm.PHASES}
+        metrics = [client.metrics for client in connected if client.metrics != None]
+        return {
+            "shard": self.shard,
+            "pid": os.getpid(),
+            "clients": self.swarm.count,
+            "launched": self.launched,
+            "connected": sum(1 for client in connected if client.connected),
+            "failed": len(self.swarm.errors),
+            "phases": phases,
+            "commands": self.commands,
+            "lost_commands": self.ring.lost,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "latency": self.latency,
+            "broadcast": self.swarm.broadcaster.stats(),
+            "metrics": territorialbot.Metrics().snapshot(metrics) if len(metrics) > 0 else None,
+        }
+
+    def report(self):
+        try:
+            self.status_queue.put(self.status())
+        except Exception:
+            pass
+
+    def launch(self):
+        self.swarm.launch()
+        self.launched = True
+
+    def run(self):
+        Thread(target=self.launch, daemon=True).start()
+        next_report = 0
+        while self.running:
+            if not self.poll() and self.idle_sleep > 0:
+                time.sleep(self.idle_sleep)
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + self.report_interval
+                self.report()
+        self.shutdown()
+
+    async def run_async(self):
+        launch = asyncio.ensure_future(self.swarm.launch_async())
+        launch.add_done_callback(lambda future: setattr(self, "launched", True))
+        next_report = 0
+        while self.running:
+            self.poll()
+            # yields to the clients of this shard even when commands keep coming
+            await asyncio.sleep(self.idle_sleep)
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + self.report_interval
+                self.report()
+        launch.cancel()
+        self.shutdown()
+
+    def shutdown(self):
+        self.swarm.disconnect()
+        self.report()
+        self.ring.close()
+
+def run_shard(*args, **kwargs):
+    global current
+    current = ShardWorker(*args, **kwargs)
+    if current.asynchronous:
+        asyncio.run(current.run_async())
+    else:
+        current.run()
+
+# leader side. factory(index, proxy_options) gets the global bot index, swarm_options
+# (concurrency, connect_rate, retries, shared_decoding...) go to the Swarm of every shard
+class ShardedSwarm:
+    def __init__(self, factory, count, shards=None, proxy_options=None, asynchronous=False, slots=4096, report_interval=1, idle_sleep=0.0005, **swarm_options):
+        self.factory = factory
+        self.count = count
+        self.shards = max(1, min(shards or os.cpu_count() or 1, count))
+        self.proxy_options = proxy_options
+        self.asynchronous = asynchronous
+        self.slots = slots
+        self.report_interval = report_interval
+        self.idle_sleep = idle_sleep
+        self.swarm_options = swarm_options
+
+        self.context = multiprocessing.get_context("spawn")
+        self.ring = None
+        self.status_queue = None
+        self.processes = []
+        self.statuses = {}
+
+    # bot indexes of every shard, as even as possible
+    def ranges(self):
+        size, extra = divmod(self.count, self.shards)
+        first = 0
+        for shard in range(self.shards):
+            count = size + (1 if shard < extra else 0)
+            yield shard, first, count
+            first += count
+
+    def start(self):
+        self.ring = CommandRing(slots=self.slots)
+        self.status_queue = self.context.Queue()
+        for shard, first, count in self.ranges():
+            process = self.context.Process(
+                target=run_shard,
+                args=(shard, first, count, self.factory, self.ring.name, self.status_queue),
+                kwargs={
+                    "proxy_options": self.proxy_options,
+                    "asynchronous": self.asynchronous,
+                    "report_interval": self.report_interval,
+                    "idle_sleep": self.idle_sleep,
+                    "swarm_options": self.swarm_options,
+                },
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+    def send(self, command, a=0, b=0, c=0, shard=ALL):
+        return self.ring.put(command, a, b, c, shard)
+
+    def attack(self, percentage, target, shard=ALL):
+        return self.send(ATTACK, percentage, target, shard=shard)
+
+    def money(self, target, percentage, shard=ALL):
+        return self.send(MONEY, target, percentage, shard=shard)
+
+    def set_base(self, pos, shard=ALL):
+        return self.send(SET_BASE, pos, shard=shard)
+
+    def clan_request(self, player, shard=ALL):
+        return self.send(CLAN_REQUEST, player, shard=shard)
+
+    # latest report of every shard that reported so far
+    def status(self):
+        while True:
+            try:
+                status = self.status_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.statuses[status["shard"]] = status
+        return dict(self.statuses)
+
+    def wait_for(self, phase, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            statuses = self.status()
+            if len(statuses) == self.shards and all(
+                status["launched"] and status["phases"][phase] == status["clients"] - status["failed"]
+                for status in statuses.values()
+            ):
+                return True
+            time.sleep(0.05)
+        return False
+
+    # metrics of all shards summed the way Metrics.snapshot sums clients
+    def snapshot(self):
+        total = {"frames_in": {}, "bytes_in": {}, "frames_out": {}, "bytes_out": {}, "events_in": {}, "counters": {}, "gauges": {}}
+        histograms = {"command_latency": territorialbot.Histogram()}
+        clients = 0
+        for status in self.status().values():
+            histograms["command_latency"].merge(status["latency"])
+            snapshot = status["metrics"]
+            if snapshot == None:
+                continue
+            clients += snapshot["clients"]
+            for name, table in total.items():
+                for key, value in snapshot[name].items():
+                    table[key] = table.get(key, 0) + value
+            for key, histogram in snapshot["histograms"].items():
+                histograms.setdefault(key, territorialbot.Histogram()).merge(histogram)
+        total["clients"] = clients
+        total["histograms"] = histograms
+        return total
+
+    def stop(self, timeout=10):
+        if self.ring == None:
+            return
+        self.send(STOP)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+        # last reports sent on the way out
+        self.status()
+        self.ring.close()
+        self.ring = None
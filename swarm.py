@@ -0,0 +1,324 @@
+import asyncio
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Lock, Thread
+
+import aiows
+import lobby
+import territorialbot
+
+PHASES = ["connect", "init", "challenge_issued", "challenge", "accepted", "joined", "switched"]
+
+# spaces connection attempts so that no more than rate connects start per second
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = 0
+        self.lock = Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+            return slot - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# actions for Swarm.broadcast, encoded once for the whole swarm
+def attack_action(percentage, target):
+    return territorialbot.ATTACK_PACKET.encode(percentage, target)
+
+def money_action(target, percentage):
+    return territorialbot.MONEY_PACKET.encode(percentage, target)
+
+def clan_request_action(player):
+    return territorialbot.CLAN_REQUEST_PACKET.encode(player)
+
+def set_base_action(pos):
+    return territorialbot.SET_BASE_PACKET.encode(pos)
+
+# single writer for swarm broadcasts. every action is framed for each socket with its own
+# masking key (RFC 6455 wants a fresh one per frame), then the frames are written back to
+# back, the time between the first and the last write is kept as the spread
+class Broadcaster:
+    def __init__(self, history=1000):
+        self.queue = Queue()
+        self.spreads = deque(maxlen=history)
+        self.sent = 0
+        self.thread = None
+
+    def submit(self, clients, payload):
+        # async clients share one event loop, write from a single callback on it
+        loops = {client.loop for client in clients if getattr(client, "loop", None) != None}
+        if len(loops) == 1 and all(getattr(client, "loop", None) != None for client in clients):
+            loops.pop().call_soon_threadsafe(self.write_all, clients, payload)
+            return
+
+        if self.thread == None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.queue.put((clients, payload))
+
+    def run(self):
+        while True:
+            clients, payload = self.queue.get()
+            self.write_all(clients, payload)
+
+    def write_all(self, clients, payload):
+        if len(clients) == 0:
+            return
+
+        # framed before the first write, so framing does not add to the spread
+        frames = [aiows.encode_frame(aiows.OPCODE_BINARY, payload, True) for _ in clients]
+        clients[0].send_raw(frames[0], payload, "broadcast")
+        first = time.perf_counter()
+        for client, frame in zip(clients[1:], frames[1:]):
+            client.send_raw(frame, payload, "broadcast")
+        self.spreads.append(time.perf_counter() - first)
+        self.sent += 1
+
+    def stats(self):
+        spreads = sorted(self.spreads)
+        if len(spreads) == 0:
+            return {"broadcasts": self.sent}
+        return {
+            "broadcasts": self.sent,
+            "last_spread": self.spreads[-1],
+            "median_spread": spreads[len(spreads) // 2],
+            "p95_spread": spreads[min(len(spreads) - 1, int(len(spreads) * 0.95))],
+            "max_spread": spreads[-1],
+        }
+
+# clients of a swarm that sit in the same game room receive the same broadcast frames.
+# the hub lets the first of them (the leader) decode that stream once and hand every event
+# to the handlers of all members, the others only look for private events addressed to them
+class RoomHub:
+    def __init__(self):
+        self.lock = Lock()
+        self.rooms = {}
+        self.membership = {}
+
+    def join(self, client):
+        with self.lock:
+            self.remove(client)
+            if client.room_key == None:
+                return
+
+            members = self.rooms.setdefault(client.room_key, [])
+            # one match.MatchState per room, the leader feeds it for everybody
+            if client.match != None:
+                for member in members:
+                    if member.match != None:
+                        client.match = member.match
+                        break
+            members.append(client)
+            self.membership[client] = client.room_key
+            self.elect(members)
+
+    def leave(self, client):
+        with self.lock:
+            self.remove(client)
+
+    def remove(self, client):
+        key = self.membership.pop(client, None)
+        if key == None:
+            return
+
+        members = self.rooms[key]
+        members.remove(client)
+        client.decode_broadcast = True
+        client.receivers = (client,)
+
+        if len(members) > 0:
+            self.elect(members)
+        else:
+            del self.rooms[key]
+
+    @staticmethod
+    def elect(members):
+        leader = members[0]
+        for member in members[1:]:
+            member.decode_broadcast = False
+            member.receivers = (member,)
+        leader.receivers = tuple(members)
+        leader.decode_broadcast = True
+
+    def leader(self, room_key):
+        with self.lock:
+            members = self.rooms.get(room_key)
+            return members[0] if members else None
+
+# brings up many clients concurrently instead of one blocking handshake after another.
+# factory(index, proxy_options) must return a new, not started Client (or AsyncClient),
+# proxies are handed out round-robin and failed connects are retried with jittered backoff.
+# with shared_decoding clients in the same room share one decoder through a RoomHub
+# and all clients one LobbyState, so a lobby frame is decoded once for the swarm
+class Swarm:
+    def __init__(self, factory, count, concurrency=16, connect_rate=20, proxy_options=None, retries=3, backoff=0.5, max_backoff=10, shared_decoding=False):
+        self.factory = factory
+        self.count = count
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(connect_rate)
+        self.proxy_options = proxy_options or [None]
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.clients = [None] * count
+        self.attempts = [0] * count
+        self.errors = {}
+        self.launch_time = None
+        self.hub = RoomHub() if shared_decoding else None
+        self.lobby = lobby.LobbyState() if shared_decoding else None
+        self.broadcaster = Broadcaster()
+
+    def create_client(self, index):
+        client = self.factory(index, self.proxy_for(index))
+        client.room_hub = self.hub
+        if self.lobby != None:
+            client.lobby = self.lobby
+        return client
+
+    def proxy_for(self, index):
+        return self.proxy_options[index % len(self.proxy_options)]
+
+    def retry_delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.5)
+
+    def launch_one(self, index):
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            self.attempts[index] += 1
+            client = self.create_client(index)
+            if attempt > 0 and client.metrics != None:
+                client.metrics.count("reconnects")
+            try:
+                client.start()
+            except Exception as e:
+                client.disconnect()
+                self.errors[index] = e
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay(attempt))
+                continue
+
+            self.errors.pop(index, None)
+            self.clients[index] = client
+            return client
+        return None
+
+    def launch(self):
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(self.launch_one, range(self.count)))
+        self.launch_time = time.monotonic() - started
+        return self.connected()
+
+    async def launch_one_async(self, index, semaphore):
+        for attempt in range(self.retries + 1):
+            async with semaphore:
+                await self.limiter.wait_async()
+                self.attempts[index] += 1
+                client = self.create_client(index)
+                if attempt > 0 and client.metrics != None:
+                    client.metrics.count("reconnects")
+                try:
+                    await client.connect()
+                except Exception as e:
+                    self.errors[index] = e
+                    client = None
+
+            if client != None:
+                self.errors.pop(index, None)
+                self.clients[index] = client
+                asyncio.ensure_future(client.listen())
+                return client
+
+            if attempt < self.retries:
+                await asyncio.sleep(self.retry_delay(attempt))
+        return None
+
+    async def launch_async(self):
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self.launch_one_async(index, semaphore) for index in range(self.count)))
+        self.launch_time = time.monotonic() - started
+        return self.connected()
+
+    def connected(self):
+        return [client for client in self.clients if client != None]
+
+    def wait_for(self, phase, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if all(phase in client.phase_times for client in self.connected()):
+                return True
+            time.sleep(0.05)
+        return False
+
+    async def wait_for_async(self, phase, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if all(phase in client.phase_times for client in self.connected()):
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+    # seconds from the start of each client's successful attempt to every handshake phase
+    def timings(self):
+        report = {}
+        for phase in PHASES:
+            durations = sorted(
+                client.phase_times[phase] - client.phase_times["start"]
+                for client in self.connected()
+                if phase in client.phase_times
+            )
+            if len(durations) == 0:
+                continue
+            report[phase] = {
+                "count": len(durations),
+                "min": durations[0],
+                "median": durations[len(durations) // 2],
+                "p95": durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+                "max": durations[-1],
+            }
+        return {
+            "clients": self.count,
+            "connected": len(self.connected()),
+            "failed": len(self.errors),
+            "attempts": sum(self.attempts),
+            "launch_time": self.launch_time,
+            "phases": report,
+        }
+
+    # sends one pre-encoded action (see attack_action and friends) to every connected client,
+    # or to the given clients, in one tick
+    def broadcast(self, action, clients=None):
+        if clients == None:
+            clients = [client for client in self.connected() if client.connected]
+        self.broadcaster.submit(clients, action)
+
+    # the client that should trigger swarm wide reactions to room events, so they are sent once
+    def is_leader(self, client):
+        if self.hub != None and client.room_key != None:
+            return self.hub.leader(client.room_key) is client
+        for other in self.connected():
+            if other.connected:
+                return other is client
+        return False
+
+    def disconnect(self):
+        for client in self.connected():
+            client.disconnect()
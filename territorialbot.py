@@ -1,19 +1,95 @@
 import websocket
+import asyncio
+import os
 import time
-import numpy as np
 import ssl
 import random
-from threading import Thread
+import select
+import socket
+import struct
+import sys
+from urllib.parse import urlparse
+from bisect import bisect_left
+from collections import deque
+from functools import lru_cache
+from threading import Thread, Lock, Event, Condition
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import aiows
+import eventlog
+import lobby
+import protocol
+import roster
 
 LOBBY_ADDRESS = "wss://territorial.io/i31/"
+# game server of a room, formatted with the index from the game scene
+GAME_ADDRESS = "wss://territorial.io/i3{index}/"
+SSLOPT = {"cert_reqs": ssl.CERT_NONE}
+PING_INTERVAL = 15
+# seconds a blocking send may wait for a full socket buffer before the client gives up on
+# the connection, reads are not limited
+SEND_TIMEOUT = 5
+
+# storage behind Buffer. "numpy" keeps buf.buffer a uint8 array like before, "lean" uses
+# plain bytearray/memoryview and leaves numpy unimported, which starts faster and costs
+# less per frame. chosen with TERRITORIALBOT_BACKEND or set_backend() before use
+BACKEND = os.environ.get("TERRITORIALBOT_BACKEND", "numpy")
+np = None
+
+def numpy_storage(size, data):
+    buffer = np.zeros(size, dtype=np.uint8) if data == None else np.frombuffer(data, dtype=np.uint8)
+    return buffer, memoryview(buffer)
+
+def lean_storage(size, data):
+    view = memoryview(bytearray(size)) if data == None else memoryview(data)
+    return view, view
+
+def set_backend(name):
+    global BACKEND, np, buffer_storage
+    if name == "numpy":
+        import numpy
+        np = numpy
+        buffer_storage = numpy_storage
+    elif name == "lean":
+        buffer_storage = lean_storage
+    else:
+        raise ValueError(f"unknown backend {name}")
+    BACKEND = name
+
+set_backend(BACKEND)
+
+# both generators iterate value = 1 + value * multiplier % modulus tens of thousands of times.
+# that is the affine map x -> multiplier * x + 1 (mod modulus), so n steps can be jumped at once:
+# x = multiplier^n * x + (multiplier^n - 1) / (multiplier - 1), kept in range 1..modulus like the loop
+def affine_steps(value, multiplier, modulus, steps):
+    if steps == 0:
+        return value
+
+    value %= modulus
+    if multiplier == 0:
+        return 1
+    elif multiplier == 1:
+        residue = value + steps
+    else:
+        # modulo (multiplier - 1) * modulus keeps the geometric sum exactly divisible
+        power = pow(multiplier, steps, (multiplier - 1) * modulus)
+        residue = power * value + (power - 1) // (multiplier - 1)
+
+    residue %= modulus
+    return residue if residue != 0 else modulus
 
 # old challenge generator, used to be in july 2024 game version
 class ChallengeGeneratorOld:
+    def __init__(self, fast=True):
+        self.fast = fast
+
     def clamp(self, db, a9S, min_value, max_value):
         return min_value + (db * a9S + 137) % (max_value - min_value)
 
     def generate_challenge(self, low, high):
         result = 1
+        fast = self.fast
 
         def update_result(result, low, high, i):
             base_value = 65536
@@ -23,6 +99,9 @@ class ChallengeGeneratorOld:
             masked = multiplied & mask_value
             eZ = base_value + masked
 
+            if fast:
+                return affine_steps(result, low, high, eZ)
+
             for j in range(eZ):
                 temp = result * low
                 modded = temp % high
@@ -42,6 +121,9 @@ class ChallengeGeneratorOld:
 # new challenge generator for august 2024 game version
 # variable names preserved from obfuscated js
 class ChallengeGenerator:
+    def __init__(self, fast=True):
+        self.fast = fast
+
     def clamp(self, b8, a24, min_value, max_value):
         return min_value + (b8 * a24 + 137) % (max_value - min_value)
 
@@ -55,19 +137,519 @@ class ChallengeGenerator:
 
     def _update_result(self, aEk, aEh, aEi, bJ):
         aL = 65536 + ((aEk * bJ + 7) & 16383)
+        if self.fast:
+            return affine_steps(aEk, aEh, aEi, aL)
         for _ in range(aL):
             aEk = 1 + (aEk * aEh) % aEi
         return aEk
 
+# servers reissue the same challenges, so answers are remembered per (y1, y2)
+@lru_cache(maxsize=4096)
+def solve_challenge(y1, y2):
+    return ChallengeGenerator().generate_challenge(y1, y2)
+
+def _solve_challenge_timed(y1, y2, fast):
+    started = time.perf_counter()
+    if fast:
+        y = solve_challenge(y1, y2)
+    else:
+        y = ChallengeGenerator(fast=False).generate_challenge(y1, y2)
+    return y, time.perf_counter() - started
+
+# process pool shared by many clients, so challenges are solved in parallel
+# and outside of the listen threads
+class ChallengePool:
+    def __init__(self, workers=None, fast=True):
+        self.fast = fast
+        # imported here, most processes never solve challenges in a pool
+        from concurrent.futures import ProcessPoolExecutor
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.lock = Lock()
+
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.solved = 0
+        self.failed = 0
+        self.solved_inline = 0
+        self.callback_errors = 0
+        self.solve_time_total = 0.0
+        self.solve_time_max = 0.0
+        self.wait_time_total = 0.0
+
+    def submit(self, y1, y2, callback):
+        with self.lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+        submitted = time.perf_counter()
+        try:
+            future = self.executor.submit(_solve_challenge_timed, y1, y2, self.fast)
+        except Exception:
+            # broken or shut down pool
+            self.solve_inline(y1, y2, callback)
+            return None
+
+        def on_done(future):
+            latency = time.perf_counter() - submitted
+            try:
+                y, solve_time = future.result()
+            except Exception:
+                self.solve_inline(y1, y2, callback)
+                return
+
+            with self.lock:
+                self.queue_depth -= 1
+                self.solved += 1
+                self.solve_time_total += solve_time
+                self.solve_time_max = max(self.solve_time_max, solve_time)
+                self.wait_time_total += latency - solve_time
+            # on_done runs on the manager thread of the pool, the callback sends the
+            # reply on the socket of the client and must not hold up other results
+            WRITERS.submit(self.deliver, callback, y)
+
+        future.add_done_callback(on_done)
+        return future
+
+    # the pool failed, the client still gets its answer so the handshake goes on
+    def solve_inline(self, y1, y2, callback):
+        with self.lock:
+            self.queue_depth -= 1
+            self.failed += 1
+            self.solved_inline += 1
+        WRITERS.submit(lambda: self.deliver(callback, solve_challenge(y1, y2)))
+
+    def deliver(self, callback, y):
+        try:
+            callback(y)
+        except Exception:
+            with self.lock:
+                self.callback_errors += 1
+
+    def stats(self):
+        with self.lock:
+            solved = max(self.solved, 1)
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "solved": self.solved,
+                "failed": self.failed,
+                "solved_inline": self.solved_inline,
+                "callback_errors": self.callback_errors,
+                "avg_solve_time": self.solve_time_total / solved,
+                "max_solve_time": self.solve_time_max,
+                "avg_wait_time": self.wait_time_total / solved,
+            }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+class Timer:
+    def __init__(self, when, interval, jitter, callback, args):
+        self.when = when
+        self.interval = interval
+        self.jitter = jitter
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    def cancel(self):
+        self.active = False
+
+# one thread and a heap of timers for every client, instead of a sleeping thread per heartbeat.
+# callbacks run on the scheduler thread one after another, so they must return quickly,
+# clients hand anything that touches a socket to WRITERS or their event loop.
+# cancelled timers stay in the heap and are dropped when they come up
+class Scheduler:
+    def __init__(self):
+        self.heap = []
+        self.condition = Condition()
+        self.counter = itertools.count()
+        self.thread = None
+        self.errors = 0
+
+    def call_at(self, when, callback, *args, interval=None, jitter=0):
+        timer = Timer(when, interval, jitter, callback, args)
+        self.push(timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    # repeats every interval, each period moved by up to +-jitter seconds.
+    # the first call is after first seconds, or a random part of the interval so that
+    # timers created together do not fire together
+    def call_every(self, interval, callback, *args, jitter=0, first=None):
+        if first == None:
+            first = random.uniform(0, interval)
+        return self.call_at(time.monotonic() + first, callback, *args, interval=interval, jitter=jitter)
+
+    def push(self, timer):
+        with self.condition:
+            heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+            if self.thread == None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if self.heap[0][2] is timer:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if len(self.heap) > 0 and self.heap[0][0] <= now:
+                        break
+                    self.condition.wait(self.heap[0][0] - now if len(self.heap) > 0 else None)
+                timer = heapq.heappop(self.heap)[2]
+
+            if not timer.active:
+                continue
+            if timer.interval == None:
+                timer.active = False
+
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                self.errors += 1
+
+            if timer.active and timer.interval != None:
+                timer.when = max(timer.when + timer.interval + random.uniform(-timer.jitter, timer.jitter), time.monotonic())
+                self.push(timer)
+
+    def pending(self):
+        with self.condition:
+            return sum(1 for entry in self.heap if entry[2].active)
+
+SCHEDULER = Scheduler()
+
+# SO_SNDTIMEO only limits sends, a listen thread waiting in recv is not affected
+def set_send_timeout(sock, seconds):
+    if sock == None or seconds == None:
+        return
+    if sys.platform == "win32":
+        value = struct.pack("I", int(seconds * 1000))
+    else:
+        value = struct.pack("ll", int(seconds), int(seconds % 1 * 1000000))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+    except OSError:
+        pass
+
+# threads that run the timers (heartbeats, outbound flushes) of threaded clients, see Client.run_timer
+WRITERS = ThreadPoolExecutor(max_workers=4)
+WRITES_LOCK = Lock()
+
+# per client queue of game actions. send_attack and friends return right away, the queue is
+# flushed once per tick, so repeated actions with the same key (an attack on the same target,
+# a base placement) are merged into the latest one. with rate set a token bucket of burst
+# actions limits how many are written per second, the rest wait for the next token.
+# when max_size actions are waiting new ones are dropped
+class OutboundQueue:
+    def __init__(self, tick=0.02, rate=None, burst=10, max_size=256):
+        self.tick = tick
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self.client = None
+        self.lock = Lock()
+
+        self.items = []
+        self.keys = {}
+        self.scheduled = False
+        self.tokens = burst
+        self.refilled = time.monotonic()
+
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def bind(self, client):
+        self.client = client
+        return self
+
+    def put(self, data, log="", key=None):
+        metrics = self.client.metrics
+        with self.lock:
+            if key != None and key in self.keys:
+                self.keys[key][1:] = [data, log]
+                self.coalesced += 1
+                if metrics != None:
+                    metrics.count("outbound_coalesced")
+                return
+
+            if len(self.items) >= self.max_size:
+                self.dropped += 1
+                if metrics != None:
+                    metrics.count("outbound_dropped")
+                return
+
+            entry = [key, data, log]
+            self.items.append(entry)
+            if key != None:
+                self.keys[key] = entry
+            self.max_depth = max(self.max_depth, len(self.items))
+            if metrics != None:
+                metrics.gauge("outbound_queue_depth", len(self.items))
+
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.client.call_later(self.tick, self.flush)
+
+    # runs on a WRITERS thread for threaded clients and on the event loop for async ones
+    def flush(self):
+        self.drain()
+
+    def take_tokens(self, count):
+        if self.rate == None:
+            return count
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        count = min(count, int(self.tokens))
+        self.tokens -= count
+        return count
+
+    def drain(self):
+        with self.lock:
+            count = self.take_tokens(len(self.items))
+            batch, self.items = self.items[:count], self.items[count:]
+            for key, data, log in batch:
+                if key != None:
+                    del self.keys[key]
+
+            delay = None
+            if len(self.items) > 0:
+                # the rest goes out as soon as the bucket has a token again
+                delay = max(self.tick, (1 - self.tokens) / self.rate)
+            else:
+                self.scheduled = False
+            if self.client.metrics != None:
+                self.client.metrics.gauge("outbound_queue_depth", len(self.items))
+
+        for key, data, log in batch:
+            self.client.send_data(data, log)
+        self.sent += len(batch)
+
+        if delay != None:
+            self.client.call_later(delay, self.flush)
+
+    def clear(self):
+        with self.lock:
+            self.items = []
+            self.keys = {}
+            self.scheduled = False
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": len(self.items),
+                "max_depth": self.max_depth,
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+            }
+
+# idle tcp (+tls) sockets to the game hosts, opened before the redirect so that switching
+# servers only costs the websocket upgrade. every game server is a path on the same host,
+# so sockets are kept per (host, port, proxy) and the path is only chosen on take.
+# tls sessions are remembered per host and resumed by new sockets. threaded clients only,
+# AsyncClient refuses a pool
+class ConnectionPool:
+    def __init__(self, max_idle=20, refresh_interval=2, timeout=5):
+        self.max_idle = max_idle
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.lock = Lock()
+
+        self.context = ssl.create_default_context()
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+
+        self.idle = {}
+        self.targets = {}
+        self.sessions = {}
+        self.thread = None
+        self.wake = Event()
+
+        self.taken = 0
+        self.warm_hits = 0
+        self.resumed = 0
+
+    @staticmethod
+    def key(url, proxy_options):
+        parsed = urlparse(url)
+        secure = parsed.scheme == "wss"
+        return parsed.hostname, parsed.port or (443 if secure else 80), secure, tuple(proxy_options or ())
+
+    @staticmethod
+    def poolable(key):
+        # socks proxies are left to websocket-client
+        return len(key[3]) == 0 or key[3][0] == "http"
+
+    # keeps count more sockets open for url until they are taken by connect(reserved=True)
+    # or given back with release()
+    def prewarm(self, url, count=1, proxy_options=None):
+        key = self.key(url, proxy_options)
+        if not self.poolable(key):
+            return
+
+        with self.lock:
+            self.targets[key] = self.targets.get(key, 0) + count
+            if self.thread == None:
+                self.thread = Thread(target=self.refresh_loop, daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    # the reserved connections will not be made (the client went away before its redirect)
+    def release(self, url, count=1, proxy_options=None):
+        key = self.key(url, proxy_options)
+        with self.lock:
+            if self.targets.get(key, 0) > 0:
+                self.targets[key] = max(0, self.targets[key] - count)
+
+    def open_socket(self, key):
+        host, port, secure, proxy_options = key
+        if len(proxy_options) > 0:
+            sock = socket.create_connection((proxy_options[1], proxy_options[2]), self.timeout)
+            sock.sendall(f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode())
+            response = b""
+            while b"\r\n\r\n" not in response:
+                chunk = sock.recv(1024)
+                if len(chunk) == 0:
+                    break
+                response += chunk
+            if b" 200" not in response.split(b"\r\n", 1)[0]:
+                sock.close()
+                raise ConnectionError(f"proxy refused tunnel: {response[:64]}")
+        else:
+            sock = socket.create_connection((host, port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if secure:
+            sock = self.context.wrap_socket(sock, server_hostname=host, session=self.sessions.get(host))
+            if sock.session_reused:
+                with self.lock:
+                    self.resumed += 1
+        return sock, time.monotonic()
+
+    @staticmethod
+    def alive(sock):
+        # an idle socket has nothing to read, apart from tls 1.3 session tickets
+        readable, _, _ = select.select([sock], [], [], 0)
+        if len(readable) == 0:
+            return True
+
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            # eof or unexpected data, either way the socket is unusable
+            sock.recv(1)
+            return False
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def take_socket(self, key, reserved=False):
+        with self.lock:
+            self.taken += 1
+            if reserved and self.targets.get(key, 0) > 0:
+                self.targets[key] -= 1
+            idle = self.idle.get(key, [])
+
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if len(idle) == 0:
+                    break
+                sock, opened = idle.pop()
+            if now - opened < self.max_idle and self.alive(sock):
+                with self.lock:
+                    self.warm_hits += 1
+                return sock
+            sock.close()
+
+        return self.open_socket(key)[0]
+
+    def refresh_loop(self):
+        while True:
+            with self.lock:
+                work = list(self.targets.items())
+            for key, target in work:
+                self.refresh(key, target)
+            self.wake.wait(self.refresh_interval)
+            self.wake.clear()
+
+    # drops sockets close to max_idle and tops the pool of key up to target
+    def refresh(self, key, target):
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            stale = [entry for entry in idle if now - entry[1] >= self.max_idle - self.refresh_interval]
+            for entry in stale:
+                idle.remove(entry)
+            missing = target - len(idle)
+
+        for sock, opened in stale:
+            sock.close()
+
+        for i in range(missing):
+            try:
+                entry = self.open_socket(key)
+            except OSError:
+                return
+            with self.lock:
+                idle.append(entry)
+
+    # websocket over a warm socket when there is one, with the same proxy and tls settings either way.
+    # reserved takes one of the sockets asked for with prewarm, other connects leave the targets alone
+    def connect(self, url, proxy_options=None, sslopt=SSLOPT, reserved=False):
+        key = self.key(url, proxy_options)
+        if not self.poolable(key):
+            return websocket.create_connection(
+                url,
+                proxy_type=proxy_options[0],
+                http_proxy_host=proxy_options[1],
+                http_proxy_port=proxy_options[2],
+                http_proxy_timeout=self.timeout,
+                sslopt=sslopt
+            )
+
+        sock = self.take_socket(key, reserved)
+        try:
+            ws = websocket.create_connection(url, socket=sock, sslopt=sslopt, timeout=self.timeout)
+        except Exception:
+            sock.close()
+            raise
+        ws.settimeout(None)
+
+        if key[2]:
+            self.sessions[key[0]] = sock.session
+        return ws
+
+    def stats(self):
+        with self.lock:
+            return {
+                "idle": sum(len(idle) for idle in self.idle.values()),
+                "taken": self.taken,
+                "warm_hits": self.warm_hits,
+                "resumed_sessions": self.resumed,
+            }
+
 class Buffer:
+    __slots__ = ("write_offset", "read_offset", "buffer", "view", "size_bits")
+
     def __init__(self, size=None, data=None):
         self.write_offset = 0
         self.read_offset = 0
 
-        if data == None:
-            self.buffer = np.zeros(size, dtype=np.uint8)
-        else:
-            self.buffer = np.frombuffer(data, dtype=np.uint8)
+        # bits are read and written as whole byte spans through view
+        self.buffer, self.view = buffer_storage(size, data)
+        self.size_bits = len(self.view) * 8
 
     @staticmethod
     def calculate_array_index(bit_index, element_size):
@@ -78,76 +660,453 @@ class Buffer:
         return Buffer.calculate_array_index(bits, 8) + (bits % 8 > 0 if 1 else 0)
 
     def write_bits(self, bits_count, value):
-        for i in range(self.write_offset, self.write_offset + bits_count):
-            cj = Buffer.calculate_array_index(i, 8)
-            self.buffer[cj] = ((value >> bits_count - (i - self.write_offset + 1)) & 1) << 7 - i % 8 | self.buffer[cj]
-        self.write_offset += bits_count
+        offset = self.write_offset
+        end = offset + bits_count
+        if end > self.size_bits:
+            raise IndexError("write past the end of buffer")
+
+        start = offset >> 3
+        stop = (end + 7) >> 3
+        span = self.view[start:stop]
+        value = (value & ((1 << bits_count) - 1)) << ((stop << 3) - end)
+        span[:] = (int.from_bytes(span, "big") | value).to_bytes(stop - start, "big")
+        self.write_offset = end
 
     def decode_bits(self, bits_count):
-        result = 0
-        for i in range(self.read_offset, self.read_offset + bits_count):
-            result |= (self.buffer[self.calculate_array_index(i, 8)] >> 7 - i % 8 & 1) << self.read_offset + bits_count - i - 1
-        self.read_offset += bits_count
-        return int(result)
+        offset = self.read_offset
+        end = offset + bits_count
+        if end > self.size_bits:
+            raise IndexError("read past the end of buffer")
+
+        start = offset >> 3
+        stop = (end + 7) >> 3
+        self.read_offset = end
+        return (int.from_bytes(self.view[start:stop], "big") >> ((stop << 3) - end)) & ((1 << bits_count) - 1)
+
+    def write_fields(self, widths, values):
+        packed = 0
+        total = 0
+        for width, value in zip(widths, values):
+            packed = (packed << width) | (value & ((1 << width) - 1))
+            total += width
+        self.write_bits(total, packed)
+
+    def read_fields(self, widths):
+        packed = self.decode_bits(sum(widths))
+        fields = []
+        for width in reversed(widths):
+            fields.append(packed & ((1 << width) - 1))
+            packed >>= width
+        fields.reverse()
+        return fields
 
     def write_str(self, string):
-        for i in range(len(string)):
-            self.write_bits(16, ord(string[i]))
+        self.write_fields((16,) * len(string), map(ord, string))
 
     def read_str(self, length):
-        chars = []
-        for i in range(length):
-            symbol = "?"
-            try:
-                symbol = chr(self.decode_bits(16))
-            except:
-                pass
-            chars.append(symbol)
-        
+        try:
+            chars = [chr(code) for code in self.read_fields((16,) * length)]
+        except IndexError:
+            # truncated string, keep the readable part and mark the rest
+            chars = []
+            for i in range(length):
+                symbol = "?"
+                try:
+                    symbol = chr(self.decode_bits(16))
+                except:
+                    pass
+                chars.append(symbol)
+
         result = "".join(chars)
         result = result.encode("utf-16", "surrogatepass").decode("utf-16", "surrogatepass")
         return result
 
+# per event id handler table. game events are decoded into protocol event tuples
+# only when some handler is registered for their id
+class EventDispatcher:
+    __slots__ = ("handlers", "private_handlers", "timer", "wrapped")
+
+    def __init__(self, timer=None):
+        self.handlers = [None] * 16
+        self.private_handlers = [None] * 16
+
+        # with metrics enabled handlers are wrapped once here, so dispatch itself stays untouched
+        self.timer = timer
+        self.wrapped = {}
+
+    @staticmethod
+    def add(table, id, handler):
+        table[id] = (table[id] or ()) + (handler,)
+
+    @staticmethod
+    def remove(table, id, handler):
+        if table[id] != None:
+            remaining = tuple(h for h in table[id] if h != handler)
+            table[id] = remaining if len(remaining) > 0 else None
+
+    def wrap(self, kind, id, handler):
+        if self.timer == None:
+            return handler
+        wrapper = self.timer.timed("callback", f"{kind}:{id}", handler)
+        self.wrapped[(kind, id, handler)] = wrapper
+        return wrapper
+
+    def on(self, id, handler):
+        self.add(self.handlers, id, self.wrap("event", id, handler))
+
+    def off(self, id, handler):
+        self.remove(self.handlers, id, self.wrapped.pop(("event", id, handler), handler))
+
+    def on_private(self, id, handler):
+        self.add(self.private_handlers, id, self.wrap("private", id, handler))
+
+    def off_private(self, id, handler):
+        self.remove(self.private_handlers, id, self.wrapped.pop(("private", id, handler), handler))
+
+# latency histogram with fixed buckets in seconds, exported the prometheus way
+class Histogram:
+    BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+# counters and timings of one client. frames are keyed by (kind, event id), kind is
+# "lobby" for lobby protocol messages, "action" for game actions we send, "game" for
+# broadcast frames and "private" for private events we receive
+class ClientMetrics:
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.lock = Lock()
+        self.frames_in = {}
+        self.bytes_in = {}
+        self.frames_out = {}
+        self.bytes_out = {}
+        self.events_in = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def frame_in(self, kind, id, size):
+        key = (kind, id)
+        with self.lock:
+            self.frames_in[key] = self.frames_in.get(key, 0) + 1
+            self.bytes_in[key] = self.bytes_in.get(key, 0) + size
+
+    def frame_out(self, data):
+        first = data[0]
+        key = ("lobby", (first >> 1) & 63) if first < 128 else ("action", (first >> 3) & 15)
+        with self.lock:
+            self.frames_out[key] = self.frames_out.get(key, 0) + 1
+            self.bytes_out[key] = self.bytes_out.get(key, 0) + len(data)
+
+    def event_in(self, id):
+        with self.lock:
+            self.events_in[id] = self.events_in.get(id, 0) + 1
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    # a client object is never reused after it disconnected, while disconnect() is called
+    # from several places for the same connection loss
+    def count_once(self, name):
+        with self.lock:
+            self.counters.setdefault(name, 1)
+
+    def observe(self, name, label, seconds):
+        key = (name, label)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def timed(self, name, label, function):
+        def wrapper(*args):
+            started = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                self.observe(name, label, time.perf_counter() - started)
+        return wrapper
+
+# shared registry, pass one to every Client(metrics=...) that should be counted.
+# metrics are off by default, a client without a registry only pays for a few None checks
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.clients = []
+
+    def client(self, nickname):
+        metrics = ClientMetrics(nickname)
+        with self.lock:
+            self.clients.append(metrics)
+        return metrics
+
+    # sum of all clients, or of the given ones
+    def snapshot(self, clients=None):
+        if clients == None:
+            with self.lock:
+                clients = list(self.clients)
+
+        total = {"frames_in": {}, "bytes_in": {}, "frames_out": {}, "bytes_out": {}, "events_in": {}, "counters": {}, "gauges": {}}
+        histograms = {}
+        for metrics in clients:
+            with metrics.lock:
+                for name, table in total.items():
+                    for key, value in getattr(metrics, name).items():
+                        table[key] = table.get(key, 0) + value
+                for key, histogram in metrics.histograms.items():
+                    histograms.setdefault(key, Histogram()).merge(histogram)
+
+        total["clients"] = len(clients)
+        total["histograms"] = histograms
+        return total
+
+    def prometheus(self, per_client=False):
+        lines = [
+            "# TYPE territorial_clients gauge",
+            f"territorial_clients {len(self.clients)}",
+        ]
+
+        if per_client:
+            with self.lock:
+                groups = [(f'client="{escape_label(metrics.nickname)}"', [metrics]) for metrics in self.clients]
+        else:
+            groups = [("", None)]
+        snapshots = [(labels, self.snapshot(clients)) for labels, clients in groups]
+
+        def join_labels(*labels):
+            labels = ",".join(label for label in labels if label)
+            return "{" + labels + "}" if labels else ""
+
+        for name, table, key_labels in (
+            ("territorial_frames_received_total", "frames_in", ("kind", "event")),
+            ("territorial_bytes_received_total", "bytes_in", ("kind", "event")),
+            ("territorial_frames_sent_total", "frames_out", ("kind", "event")),
+            ("territorial_bytes_sent_total", "bytes_out", ("kind", "event")),
+            ("territorial_game_events_received_total", "events_in", ("event",)),
+        ):
+            lines.append(f"# TYPE {name} counter")
+            for labels, snapshot in snapshots:
+                for key, value in sorted(snapshot[table].items(), key=str):
+                    key = key if isinstance(key, tuple) else (key,)
+                    extra = ",".join(f'{label}="{part}"' for label, part in zip(key_labels, key))
+                    lines.append(f"{name}{join_labels(labels, extra)} {value}")
+
+        for counter in ("disconnects", "reconnects", "outbound_coalesced", "outbound_dropped", "send_errors", "handler_errors", "timer_errors"):
+            name = f"territorial_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            for labels, snapshot in snapshots:
+                lines.append(f"{name}{join_labels(labels)} {snapshot['counters'].get(counter, 0)}")
+
+        for gauge in ("outbound_queue_depth",):
+            name = f"territorial_{gauge}"
+            lines.append(f"# TYPE {name} gauge")
+            for labels, snapshot in snapshots:
+                lines.append(f"{name}{join_labels(labels)} {snapshot['gauges'].get(gauge, 0)}")
+
+        names = sorted({key[0] for _, snapshot in snapshots for key in snapshot["histograms"]})
+        for histogram_name in names:
+            name = f"territorial_{histogram_name}_seconds"
+            label_name = "phase" if histogram_name == "phase" else "callback"
+            lines.append(f"# TYPE {name} histogram")
+            for labels, snapshot in snapshots:
+                for (key, label), histogram in sorted(snapshot["histograms"].items(), key=str):
+                    if key != histogram_name:
+                        continue
+                    own = f'{label_name}="{label}"' if label != None else ""
+                    cumulative = 0
+                    for bound, count in zip(Histogram.BUCKETS + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        le = f'le="{bound}"'
+                        lines.append(f"{name}_bucket{join_labels(labels, own, le)} {cumulative}")
+                    lines.append(f"{name}_sum{join_labels(labels, own)} {histogram.sum}")
+                    lines.append(f"{name}_count{join_labels(labels, own)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    # tiny http endpoint for prometheus scrapes, GET /metrics (?per_client for client labels)
+    def serve(self, port=9464, host="127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not self.path.startswith("/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus(per_client="per_client" in self.path).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# outgoing packet with a fixed header. the header is packed once, encode() only
+# shifts the variable fields in and returns ready to send bytes
+class PacketTemplate:
+    def __init__(self, header, fields):
+        self.fields = tuple(fields)
+        self.masks = tuple((1 << width) - 1 for width in self.fields)
+
+        prefix = 0
+        header_bits = 0
+        for width, value in header:
+            prefix = (prefix << width) | value
+            header_bits += width
+
+        bits = header_bits + sum(self.fields)
+        self.size = Buffer.bits_to_bytes(bits)
+        self.padding = self.size * 8 - bits
+        self.prefix = prefix
+        self.constant = (prefix << self.padding).to_bytes(self.size, "big") if len(self.fields) == 0 else None
+
+    def encode(self, *values):
+        if self.constant != None:
+            return self.constant
+
+        packed = self.prefix
+        for width, mask, value in zip(self.fields, self.masks, values):
+            packed = (packed << width) | (value & mask)
+        return (packed << self.padding).to_bytes(self.size, "big")
+
+    def encode_into(self, target, offset, *values):
+        target[offset:offset + self.size] = self.encode(*values)
+        return self.size
+
+INIT_PACKET = PacketTemplate(((1, 0), (6, 13)), (14, 4, 7, 1, 1, 5))
+CHALLENGE_PACKET = PacketTemplate(((1, 0), (6, 14)), (3, 16))
+ACCOUNT_INFO_PACKET = PacketTemplate(((1, 0), (6, 17)), (16, 16, 16, 16, 12, 30))
+JOIN_ROOM_PACKET = PacketTemplate(((1, 0), (6, 2)), (4,))
+READY_PACKET = PacketTemplate(((1, 0), (6, 5)), (8, 10, 9, 10, 14))
+PING_PACKET = PacketTemplate(((1, 0), (6, 4), (1, 0)), ())
+LOBBY_EVENT_PACKET = PacketTemplate(((1, 0), (6, 15)), (6,))
+SET_BASE_PACKET = PacketTemplate(((1, 1), (4, 0)), (22,))
+ATTACK_PACKET = PacketTemplate(((1, 1), (4, 1)), (10, 10))
+MONEY_PACKET = PacketTemplate(((1, 1), (4, 2)), (10, 9))
+CLAN_REQUEST_PACKET = PacketTemplate(((1, 1), (4, 14)), (9,))
+
 class Client:
-    def __init__(self, nickname, game_version=1050, logging=False, proxy_options=None, lobby_address=LOBBY_ADDRESS):
+    # thousands of mostly idle clients, no per instance dict unless something adds
+    # attributes of its own (process_message wrapped for metrics, tests replacing methods)
+    __slots__ = (
+        "connected", "connection_accepted", "game_version", "logging", "proxy_options", "inited", "join", "in_game",
+        "battle_started", "nickname", "players_info", "mine_pos", "current_time", "url", "lobby_address", "game_address",
+        "challenge_pool", "connection_pool", "scheduler", "ping_jitter", "ping_timer", "timers", "outbound", "lobby", "pool_reservation",
+        "lobby_update_callback", "lobby_delta_callback", "disconnect_callback", "connect_callback", "game_scene_callback",
+        "game_start_callback", "game_event_callback", "private_event_callback", "game_frame_callback", "phase_times",
+        "metrics", "events", "recorder", "recorder_id", "room_hub", "room_key", "decode_broadcast", "receivers",
+        "track_match", "match", "writes", "ws", "challengeX", "challengeY", "__dict__",
+    )
+
+    def __init__(self, nickname, game_version=1050, logging=False, proxy_options=None, lobby_address=LOBBY_ADDRESS, challenge_pool=None, metrics=None, game_address=GAME_ADDRESS, recorder=None, connection_pool=None, scheduler=SCHEDULER, ping_jitter=2, outbound=None, lobby_state=None, track_match=False):
         self.connected = False
         self.connection_accepted = False
         self.game_version = game_version
-        self.logging = logging
+        # eventlog.ClientLog of this client or None. logging=True writes json lines to stdout,
+        # an eventlog.EventLog writes to its own sink with its own sampling
+        if logging == True:
+            logging = eventlog.default_log()
+        self.logging = logging.client(nickname) if logging else None
         self.proxy_options = proxy_options
         self.inited = False
         self.join = False
         self.in_game = False
         self.battle_started = False
         self.nickname = nickname
-        self.players_info = []
+        # roster.Roster of the current game scene
+        self.players_info = roster.EMPTY
         self.mine_pos = None
         self.current_time = int(time.time() * 1000) % 1024 + random.randint(-20, 20)
         self.url = lobby_address
+        self.lobby_address = lobby_address
+        self.game_address = game_address
+        self.challenge_pool = challenge_pool
+        self.connection_pool = connection_pool
+        # url prewarmed in connection_pool for the redirect of this client, until it is used
+        self.pool_reservation = None
+
+        # heartbeats and delayed actions, all cancelled on disconnect
+        self.scheduler = scheduler
+        self.ping_jitter = ping_jitter
+        self.ping_timer = None
+        self.timers = ()
+        # timer callbacks waiting for WRITERS, None when none is running
+        self.writes = None
+
+        # OutboundQueue for game actions, they are written directly when None
+        self.outbound = outbound.bind(self) if outbound != None else None
+
+        # battles of the lobby kept across event 2 updates, can be shared between clients.
+        # created with the first update
+        self.lobby = lobby_state
 
         self.lobby_update_callback = None
+        self.lobby_delta_callback = None
         self.disconnect_callback = None
         self.connect_callback = None
         self.game_scene_callback = None
         self.game_start_callback = None
         self.game_event_callback = None
         self.private_event_callback = None
+        self.game_frame_callback = None
+        self.phase_times = {}
+
+        # per client counters in a shared Metrics registry, None when metrics are off
+        self.metrics = metrics.client(nickname) if metrics != None else None
+        self.events = EventDispatcher(self.metrics)
+        if self.metrics != None:
+            self.process_message = self.metrics.timed("process_message", None, self.process_message)
+
+        # capture.Recorder that keeps every frame in and out, None when not recording
+        self.recorder = recorder
+        self.recorder_id = recorder.register(nickname) if recorder != None else None
+
+        # clients sharing a game room can let one of them decode the broadcast
+        # frames for all, see swarm.RoomHub
+        self.room_hub = None
+        self.room_key = None
+        self.decode_broadcast = True
+        self.receivers = (self,)
+
+        # match.MatchState of the current game when track_match is set, clients of a
+        # RoomHub room share one
+        self.track_match = track_match
+        self.match = None
 
     def start(self):
+        self.mark_phase("start")
         self.connected = True
-
-        if self.proxy_options != None:
-            self.ws = websocket.create_connection(
-                self.url,
-                proxy_type=self.proxy_options[0],
-                http_proxy_host=self.proxy_options[1],
-                http_proxy_port=self.proxy_options[2],
-                http_proxy_timeout=5,
-                sslopt={"cert_reqs": ssl.CERT_NONE}
-            )
-        else:
-            self.ws = websocket.create_connection(self.url, sslopt={"cert_reqs": ssl.CERT_NONE})
-
+        self.ws = self.open_connection(self.url)
+        self.mark_phase("connect")
         self.send_init_message()
         Thread(target=self.listen).start()
 
@@ -158,7 +1117,9 @@ class Client:
         game_scene_callback=None,
         game_start_callback=None,
         game_event_callback=None,
-        private_event_callback=None
+        private_event_callback=None,
+        game_frame_callback=None,
+        lobby_delta_callback=None
     ):
         self.lobby_update_callback = lobby_update_callback
         self.disconnect_callback = disconnect_callback
@@ -167,74 +1128,215 @@ class Client:
         self.game_start_callback = game_start_callback
         self.game_event_callback = game_event_callback
         self.private_event_callback = private_event_callback
+        self.game_frame_callback = game_frame_callback
+        self.lobby_delta_callback = lobby_delta_callback
+
+        if self.metrics != None:
+            for name in ("lobby_update", "disconnect", "connect", "game_scene", "game_start", "game_event", "private_event", "game_frame", "lobby_delta"):
+                callback = getattr(self, name + "_callback")
+                if callback != None:
+                    setattr(self, name + "_callback", self.metrics.timed("callback", name, callback))
+
+    def start_ping(self):
+        # every game server switch asks again, one heartbeat per client is enough
+        if self.ping_timer != None and self.ping_timer.active:
+            return
+        # periods between PING_INTERVAL - ping_jitter and PING_INTERVAL, never later than the server expects.
+        # the first one too, clients that got ready together do not ping together
+        interval = PING_INTERVAL - self.ping_jitter / 2
+        first = random.uniform(PING_INTERVAL - self.ping_jitter, PING_INTERVAL)
+        self.ping_timer = self.call_every(interval, self.send_ping, jitter=self.ping_jitter / 2, first=first)
+
+    # timers of this client, run through run_timer and cancelled by disconnect()
+    def call_later(self, delay, callback, *args):
+        return self.add_timer(self.scheduler.call_later(delay, self.run_timer, callback, args))
+
+    def call_every(self, interval, callback, *args, jitter=0, first=None):
+        return self.add_timer(self.scheduler.call_every(interval, self.run_timer, callback, args, jitter=jitter, first=first))
+
+    def add_timer(self, timer):
+        self.timers = {other for other in self.timers if other.active}
+        self.timers.add(timer)
+        return timer
+
+    # the scheduler thread only dispatches. the callbacks of one client run one after another
+    # on WRITERS, so a client with a blocked socket holds one writer at most, and only until
+    # SEND_TIMEOUT ends the connection
+    def run_timer(self, callback, args):
+        if not self.connected:
+            return
+        with WRITES_LOCK:
+            if self.writes != None:
+                self.writes.append((callback, args))
+                return
+            self.writes = deque(((callback, args),))
+        WRITERS.submit(self.run_writes)
+
+    def run_writes(self):
+        while True:
+            with WRITES_LOCK:
+                if len(self.writes) == 0:
+                    self.writes = None
+                    return
+                callback, args = self.writes.popleft()
+            try:
+                self.run_timer_now(callback, args)
+            except Exception:
+                if self.metrics != None:
+                    self.metrics.count("timer_errors")
+
+    def run_timer_now(self, callback, args):
+        if self.connected:
+            callback(*args)
+
+    def cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = ()
+
+    def open_connection(self, url):
+        if self.connection_pool != None:
+            # the lobby connect has no reservation, the redirect uses the one made when accepted
+            reserved = self.pool_reservation != None
+            self.pool_reservation = None
+            ws = self.connection_pool.connect(url, self.proxy_options, reserved=reserved)
+        elif self.proxy_options != None:
+            ws = websocket.create_connection(
+                url,
+                proxy_type=self.proxy_options[0],
+                http_proxy_host=self.proxy_options[1],
+                http_proxy_port=self.proxy_options[2],
+                http_proxy_timeout=5,
+                sslopt=SSLOPT
+            )
+        else:
+            ws = websocket.create_connection(url, sslopt=SSLOPT)
+        set_send_timeout(ws.sock, SEND_TIMEOUT)
+        return ws
+
+    def switch_server(self, url):
+        if self.metrics != None:
+            self.metrics.count("reconnects")
+        self.ws.close()
+        self.ws = self.open_connection(url)
+        self.mark_phase("switched")
+        self.send_init_message()
 
-    def ping(self):
-        while self.connected:
-            time.sleep(15)
-            self.send_ping()
+    # first time the client reached each handshake phase, in time.monotonic() seconds
+    def mark_phase(self, phase):
+        if phase not in self.phase_times:
+            now = time.monotonic()
+            if self.metrics != None and len(self.phase_times) > 0:
+                # latency of each step from the phase reached before it
+                self.metrics.observe("phase", phase, now - max(self.phase_times.values()))
+            self.phase_times[phase] = now
 
     def disconnect(self):
+        self.cancel_timers()
+        if self.outbound != None:
+            self.outbound.clear()
+        if self.room_hub != None:
+            self.room_hub.leave(self)
+        if self.lobby != None:
+            self.lobby.forget(self)
+        reservation, self.pool_reservation = self.pool_reservation, None
+        if reservation != None:
+            self.connection_pool.release(reservation, 1, self.proxy_options)
+
+        if self.metrics != None and self.connected:
+            self.metrics.count_once("disconnects")
+
         try:
             if self.ws != None:
+                # the close frame waits for a full send buffer at most SEND_TIMEOUT
+                sock = getattr(self.ws, "sock", None)
+                if sock != None:
+                    sock.settimeout(SEND_TIMEOUT)
                 self.ws.close()
                 self.connected = False
         except Exception:
             pass
 
     def send_data(self, data, log=""):
-        if self.logging:
-            print("[SENT]:", log, data)
+        if self.logging != None:
+            self.logging.outbound(data)
+        if self.metrics != None:
+            self.metrics.frame_out(data)
+        if self.recorder != None:
+            self.recorder.outbound(self.recorder_id, data)
         try:
             if self.connected:
-                self.ws.send_binary(data)
-        except:
+                self.write_frame(aiows.encode_frame(aiows.OPCODE_BINARY, data, True))
+        except Exception:
+            if self.logging != None:
+                self.logging.record(eventlog.SEND_ERROR, 0, len(data))
+            if self.metrics != None:
+                self.metrics.count("send_errors")
             self.disconnect()
 
-    def send_init_message(self):
-        buf = Buffer(Buffer.bits_to_bytes(39))
-        buf.write_bits(1, 0)
-        buf.write_bits(6, 13)
-
-        buf.write_bits(14, self.game_version)
-        buf.write_bits(4, 0)
-        buf.write_bits(7, 0)
-        buf.write_bits(1, 0)
-        buf.write_bits(1, 0)
+    # game actions go through the outbound queue when the client has one
+    def send_action(self, data, log="", key=None):
+        if self.outbound != None:
+            self.outbound.put(data, log, key)
+        else:
+            self.send_data(data, log)
+
+    # writes an already framed and masked websocket message, see swarm.Swarm.broadcast.
+    # payload is the unmasked content of the frame
+    def send_raw(self, frame, payload, log=""):
+        if self.logging != None:
+            self.logging.outbound(payload)
+        if self.metrics != None:
+            self.metrics.frame_out(payload)
+        if self.recorder != None:
+            self.recorder.outbound(self.recorder_id, payload)
+        try:
+            if self.connected:
+                self.write_frame(frame)
+        except:
+            self.disconnect()
 
-        buf.write_bits(5, 12)
+    # straight to the socket, websocket-client would wait for a full buffer without end,
+    # sendall gives up after SEND_TIMEOUT
+    def write_frame(self, frame):
+        with self.ws.lock:
+            self.ws.sock.sendall(frame)
 
-        self.send_data(list(buf.buffer), "sent init")
+    def send_init_message(self):
+        self.mark_phase("init")
+        self.send_data(INIT_PACKET.encode(self.game_version, 0, 0, 0, 0, 12), "sent init")
 
     def send_challenge_response(self, buf):
-        challengeGenerator = ChallengeGenerator()
-
         x = buf.decode_bits(3)
-        y1, y2 = int(buf.decode_bits(16)), int(buf.decode_bits(20))
-        y = challengeGenerator.generate_challenge(y1, y2)
-
-        send_buf = Buffer(Buffer.bits_to_bytes(26))
-        send_buf.write_bits(1, 0)
-        send_buf.write_bits(6, 14)
-        send_buf.write_bits(3, x)
-        send_buf.write_bits(16, y)
-
-        self.send_data(list(send_buf.buffer), "sent challenge")
-
-    def send_account_info(self):
-        buf = Buffer(Buffer.bits_to_bytes(115))
-        buf.write_bits(1, 0)
-        buf.write_bits(6, 17)
+        y1, y2 = buf.decode_bits(16), buf.decode_bits(20)
 
+        if self.challenge_pool != None:
+            # reply is sent from the pool once the challenge is solved
+            self.challenge_pool.submit(y1, y2, lambda y: self.on_challenge_solved(x, y))
+        else:
+            self.on_challenge_solved(x, solve_challenge(y1, y2))
 
-        buf.write_bits(16, random.randint(0, 60000))
-        buf.write_bits(16, random.randint(0, 60000))
-        buf.write_bits(16, random.randint(0, 60000))
-        buf.write_bits(16, random.randint(0, 60000))
-        buf.write_bits(12, random.randint(0, 2000))
+    def on_challenge_solved(self, x, y):
+        self.mark_phase("challenge")
+        self.send_data(CHALLENGE_PACKET.encode(x, y), "sent challenge")
 
-        buf.write_bits(30, random.randint(100000, 300000))
+        if self.inited == False:
+            self.send_account_info()
+            if self.in_game == False:
+                self.send_session_info()
+            else:
+                self.send_ready_for_session()
+            self.inited = True
 
-        self.send_data(list(buf.buffer), "sent acc info")
+    def send_account_info(self):
+        self.send_data(ACCOUNT_INFO_PACKET.encode(
+            random.randint(0, 60000),
+            random.randint(0, 60000),
+            random.randint(0, 60000),
+            random.randint(0, 60000),
+            random.randint(0, 2000),
+            random.randint(100000, 300000)
+        ), "sent acc info")
 
     def send_session_info(self):
         buf = Buffer(Buffer.bits_to_bytes(40 + 16 * len(self.nickname)))
@@ -250,85 +1352,38 @@ class Client:
         buf.write_bits(6, 0)
         buf.write_bits(6, 0)
 
-        self.send_data(list(buf.buffer), "sent session info")
+        self.send_data(buf.buffer.tobytes(), "sent session info")
 
     def send_join_room(self, id):
-        buf = Buffer(Buffer.bits_to_bytes(11))
-        buf.write_bits(1, 0)
-        buf.write_bits(6, 2)
-        buf.write_bits(4, id)
-
-        self.send_data(list(buf.buffer), "sent join room")
+        self.send_data(JOIN_ROOM_PACKET.encode(id), "sent join room")
 
     def send_ready_for_session(self):
-        buf = Buffer(Buffer.bits_to_bytes(58))
-        buf.write_bits(1, 0)
-        buf.write_bits(6, 5)
-
-        buf.write_bits(8, 0 if self.url == "wss://territorial.io/i31/" else 1)
-
-        buf.write_bits(10, self.challengeX)
-        buf.write_bits(9, self.challengeY)
-
-        buf.write_bits(10, self.current_time)
-        buf.write_bits(14, self.game_version)
-
-        self.send_data(list(buf.buffer), "sent game start")
-        Thread(target=self.ping).start()
+        self.send_data(READY_PACKET.encode(
+            0 if self.url == self.lobby_address else 1,
+            self.challengeX,
+            self.challengeY,
+            self.current_time,
+            self.game_version
+        ), "sent game start")
+        self.start_ping()
 
     def send_set_base(self, pos):
-        buf = Buffer(Buffer.bits_to_bytes(27))
-        buf.write_bits(1, 1)
-        buf.write_bits(4, 0)
+        self.send_action(SET_BASE_PACKET.encode(pos), "set base", ("base",))
 
-        buf.write_bits(22, pos)
-
-        self.send_data(list(buf.buffer), "set base")
-    
     def send_attack(self, percentage, target):
-        buf = Buffer(Buffer.bits_to_bytes(27))
-        buf.write_bits(1, 1)
-        buf.write_bits(4, 1)
-
-        buf.write_bits(10, percentage)
-        buf.write_bits(10, target)
-
-        self.send_data(list(buf.buffer), "attack")
+        self.send_action(ATTACK_PACKET.encode(percentage, target), "attack", ("attack", target))
 
     def send_money(self, target, percentage):
-        buf = Buffer(Buffer.bits_to_bytes(24))
-        buf.write_bits(1, 1)
-        buf.write_bits(4, 2)
-
-        buf.write_bits(10, percentage)
-        buf.write_bits(9, target)
-
-        self.send_data(list(buf.buffer), "sent money")
+        self.send_action(MONEY_PACKET.encode(percentage, target), "sent money")
 
     def send_clan_request(self, player):
-        buf = Buffer(Buffer.bits_to_bytes(14))
-        buf.write_bits(1, 1)
-        buf.write_bits(4, 14)
-
-        buf.write_bits(9, player)
-
-        self.send_data(list(buf.buffer), "sent money")
+        self.send_action(CLAN_REQUEST_PACKET.encode(player), "sent clan request", ("clan", player))
 
     def send_ping(self):
-        buf = Buffer(Buffer.bits_to_bytes(8))
-        buf.write_bits(1, 0)
-        buf.write_bits(6, 4)
-        buf.write_bits(1, 0)
-
-        self.send_data(list(buf.buffer), "sent ping")
+        self.send_data(PING_PACKET.encode(), "sent ping")
 
     def send_lobby_event(self, id):
-        buf = Buffer(Buffer.bits_to_bytes(13))
-        buf.write_bits(1, 0)
-        buf.write_bits(6, 15)
-        buf.write_bits(6, id)
-
-        self.send_data(list(buf.buffer), "sent lobby event")
+        self.send_data(LOBBY_EVENT_PACKET.encode(id), "sent lobby event")
 
     def process_message(self, msg):
         try:
@@ -347,18 +1402,14 @@ class Client:
             if buf.decode_bits(1) == 0:
                 eventId = buf.decode_bits(6)
 
-                if self.logging:
-                    print("[EVENT]:", eventId, "length:", len(buf.buffer))
+                if self.logging != None:
+                    self.logging.record(eventlog.LOBBY_IN, eventId, len(buf.buffer))
+                if self.metrics != None:
+                    self.metrics.frame_in("lobby", eventId, len(buf.buffer))
 
                 if eventId == 9:
+                    self.mark_phase("challenge_issued")
                     self.send_challenge_response(buf)
-                    if self.inited == False:
-                        self.send_account_info()
-                        if self.in_game == False:
-                            self.send_session_info()
-                        else:
-                            self.send_ready_for_session()
-                        self.inited = True
                 elif eventId == 11:
                     subEventId = buf.decode_bits(6)
                     if subEventId == 0:
@@ -366,144 +1417,184 @@ class Client:
                 elif eventId == 2:
                     if self.connection_accepted == False:
                         self.connection_accepted = True
+                        self.mark_phase("accepted")
+                        if self.connection_pool != None and self.pool_reservation == None:
+                            # warm socket for the game server redirect
+                            self.pool_reservation = self.game_address.format(index=0)
+                            self.connection_pool.prewarm(self.pool_reservation, 1, self.proxy_options)
                         if self.connect_callback != None:
                             self.connect_callback(self)
 
-                    playersOnlineInfo = [0, 0, 0, 0]
-                    playersOnlineInfoLen = buf.decode_bits(6)
-                    for i in range(4):
-                        playersOnlineInfo[i] = buf.decode_bits(playersOnlineInfoLen)
-
-                    battlesInfo = []
-                    battlesCount = buf.decode_bits(4)
-
-                    for i in range(battlesCount):
-                        battlesInfo.append({
-                            "id": buf.decode_bits(5),
-                            "gamemode": buf.decode_bits(4),
-                            "crown": buf.decode_bits(1) == 1,
-                            "mapId": buf.decode_bits(6),
-                            "seed": buf.decode_bits(14),
-                            "players": buf.decode_bits(playersOnlineInfoLen),
-                            "maxPlayers": buf.decode_bits(9) + 1,
-                            "time": buf.decode_bits(10),
-                        })
-
-                        clansCount = buf.decode_bits(3)
-                        clansInfo = []
-                        for j in range(clansCount):
-                            clansInfo.append({"online": buf.decode_bits(9) + 1, "clan": buf.read_str(buf.decode_bits(3))})
-                        battlesInfo[i]["clans"] = clansInfo
+                    # decoded only when the frame is new to the lobby state, see lobby.LobbyState.update
+                    if self.lobby == None:
+                        self.lobby = lobby.LobbyState()
+                    delta = self.lobby.update(buf, self)
+                    if delta != None and self.lobby_delta_callback != None:
+                        self.lobby_delta_callback(self, delta)
 
                     if self.lobby_update_callback:
-                        self.lobby_update_callback(self, battlesInfo)
-                elif eventId == 3 or eventId == 4:
-                    buf.read_offset = 1
-
-                    x = buf.decode_bits(6)
-                    index = buf.decode_bits(10)
-                    self.challengeX = buf.decode_bits(10)
-                    if x == 3:
-                        self.challengeY = buf.decode_bits(9)
-                    else:
-                        self.challengeY = buf.decode_bits(1)
-
-                    buf.read_offset = 1
-                    if buf.decode_bits(6) == 3:
-                        buf.read_offset += 20
-
-                        localPlayerId = buf.decode_bits(9)
-                        uY = buf.decode_bits(14)
-                        ua = buf.decode_bits(4)
-                        a4V = buf.decode_bits(1) == 1
-                        a4W = buf.decode_bits(6)
-                        a4X = buf.decode_bits(14)
-                        playersCount = buf.decode_bits(9) + 1
-                        playersInfo = []
-                        
-                        for i in range(playersCount):
-                            flag = buf.decode_bits(1)
-                            colors = [buf.decode_bits(6), buf.decode_bits(6), buf.decode_bits(6)]
-                            nickname = buf.read_str(buf.decode_bits(5))
-                            playersInfo.append({"id": i, "nickname": nickname, "flag": flag})
-
-                        self.players_info = playersInfo
-                    else:
-                        pass
-
-                    self.url = f"wss://territorial.io/i3{index}/"
+                        self.lobby_update_callback(self, self.lobby.rooms)
+                elif eventId == 3:
+                    scene = protocol.decode_game_scene_head(buf)
+                    index = scene["index"]
+                    self.challengeX = scene["challengeX"]
+                    self.challengeY = scene["localPlayerId"]
+                    self.players_info = roster.Roster(buf)
+                    self.room_key = (index, scene["uY"], scene["ua"], scene["a4V"], scene["a4W"], scene["a4X"])
+                    if self.track_match:
+                        import match
+                        self.match = match.MatchState(len(self.players_info))
+                elif eventId == 4:
+                    scene = protocol.decode_game_server(buf)
+                    index = scene["index"]
+                    self.challengeX = scene["challengeX"]
+                    self.challengeY = scene["challengeY"]
+                    self.room_key = None
+                    if self.track_match:
+                        # no roster here, room for every 9 bit id
+                        import match
+                        self.match = match.MatchState()
+
+                if eventId == 3 or eventId == 4:
+                    self.mark_phase("joined")
+                    self.url = self.game_address.format(index=index)
 
                     if self.game_scene_callback != None:
                         self.game_scene_callback(self, self.players_info, self.url)
 
-                    if self.logging:
-                        print("[CONNECTED]", "Game server:", self.url, "players:", len(self.players_info))
-
-                    self.ws.close()
-                    self.ws = websocket.create_connection(self.url)
+                    if self.logging != None:
+                        self.logging.record(eventlog.CONNECTED, eventId, len(self.players_info))
 
                     self.inited = False
                     self.in_game = True
-                    self.send_init_message()
+                    self.switch_server(self.url)
+
+                    # only once connected, a leader that failed to switch would leave the room without events
+                    if self.room_hub != None:
+                        self.room_hub.join(self)
             else:
-                buf = Buffer(data=msg)
-                buf.read_offset = 2
-                size = len(buf.buffer) * 8
-                id = None
-                sender = None
-                
+                self.process_game_frame(buf)
+
+    def process_game_frame(self, buf):
+        metrics = self.metrics
+
+        if self.decode_broadcast == False:
+            # another client of the room decodes the broadcast stream for us,
+            # only frames small enough to be private events are looked at
+            if buf.size_bits <= protocol.PRIVATE_FRAME_MAX_BITS and protocol.split_game_frame(buf) == None:
+                self.process_private_event(buf)
+            elif metrics != None:
+                metrics.frame_in("game", "broadcast", len(buf.buffer))
+            return
+
+        offsets = protocol.split_game_frame(buf)
+        if offsets == None:
+            self.process_private_event(buf)
+            return
+
+        if metrics != None:
+            metrics.frame_in("game", "broadcast", len(buf.buffer))
+        receivers = self.receivers
+
+        # batch mode, the whole frame as a protocol.GAME_EVENT_DTYPE array
+        events = None
+        for client in receivers:
+            if client.game_frame_callback != None:
+                if events is None:
+                    events = protocol.decode_game_frame(buf.buffer, offsets)
+                try:
+                    client.game_frame_callback(client, events)
+                except Exception:
+                    self.receiver_failed(client)
+
+        # match states of the receivers, each fed once even when shared
+        matches = None
+        for client in receivers:
+            if client.match != None:
+                if matches == None:
+                    matches = []
+                    now = time.monotonic()
+                if client.match not in matches:
+                    matches.append(client.match)
+
+        decoders = protocol.GAME_EVENT_DECODERS
+        for offset in offsets:
+            buf.read_offset = offset
+            header = buf.decode_bits(13)
+            id = header >> 9
+            sender = header & 511
+            event = None
+            if metrics != None:
+                metrics.event_in(id)
+            if self.logging != None:
+                self.logging.record(eventlog.GAME_IN, id, len(buf.buffer))
+
+            # before the handlers, so they see the state with this event in it
+            if matches != None and id in matches[0].EVENTS:
+                buf.read_offset = offset + 13
+                event = decoders[id](buf, sender)
+                for state in matches:
+                    state.feed(event, now)
+
+            for client in receivers:
+                if id == 9:
+                    client.players_info.leave(sender)
+
                 try:
-                    while buf.read_offset + 8 <= size:
-                        id = buf.decode_bits(4)
-                        sender = buf.decode_bits(9)
-
-                        if self.game_event_callback != None:
-                            self.game_event_callback(self, buf, id, sender)
-
-                        if self.logging:
-                            pass
-                            # print("[GAME EVENT]", id)
-
-                        if id == 0: # place base
-                            pos = buf.decode_bits(22)
-                        elif id == 1: # attack
-                            if self.battle_started == False:
-                                self.battle_started = True
-                                if self.game_start_callback != None:
-                                    self.game_start_callback(self)
-
-                            percentage = buf.decode_bits(10)
-                            target = buf.decode_bits(10)
-                        elif id == 2: # send money
-                            value = buf.decode_bits(10)
-                            target = buf.decode_bits(9)
-                        elif id == 3 or id == 4:
-                            buf.decode_bits(10)
-                            buf.decode_bits(22)
-                        elif id == 5 or id == 6:
-                            emoji = buf.decode_bits(10)
-                        elif id == 7:
-                            buf.decode_bits(1)
-                        elif id == 9:
-                            pass
-                            # print("Player left", self.players_info[sender]["nickname"])
-                        else:
-                            pass
-
-                except Exception as e:
-                    # private message
-                    try:
-                        buf.read_offset = 0
-                        id = buf.decode_bits(4)
-                        sender = buf.decode_bits(9)
-                        if self.private_event_callback != None:
-                            self.private_event_callback(self, buf, id, sender)
-                    except:
-                        # double cringe
-                        pass
-
-                    # print("private message", id, sender)
-                    # print("ERROR ON READ:", "|", e, "|", id, sender, "|", buf.read_offset, "|", list(buf.buffer))
+                    if client.game_event_callback != None:
+                        buf.read_offset = offset + 13
+                        client.game_event_callback(client, buf, id, sender)
+
+                    if id == 1 and client.battle_started == False:
+                        client.battle_started = True
+                        if client.game_start_callback != None:
+                            client.game_start_callback(client)
+
+                    # events nobody subscribed to are skipped without decoding
+                    handlers = client.events.handlers[id]
+                    if handlers != None:
+                        if event == None:
+                            buf.read_offset = offset + 13
+                            event = decoders[id](buf, sender)
+                        for handler in handlers:
+                            handler(client, event)
+                except Exception:
+                    self.receiver_failed(client)
+
+    # a callback of a room member raised while this client decoded for the room. the
+    # member is disconnected as if its own listen loop had failed, the room keeps this
+    # client as leader. an error in its own callbacks still ends its own listen loop
+    def receiver_failed(self, client):
+        if client is self:
+            raise
+        if client.metrics != None:
+            client.metrics.count("handler_errors")
+        client.disconnect()
+
+    def process_private_event(self, buf):
+        if buf.size_bits < 13:
+            return
+
+        buf.read_offset = 0
+        header = buf.decode_bits(13)
+        id = header >> 9
+        sender = header & 511
+        if 13 + protocol.PRIVATE_EVENT_SIZES[id] > buf.size_bits:
+            return
+        if self.metrics != None:
+            self.metrics.frame_in("private", id, len(buf.buffer))
+        if self.logging != None:
+            self.logging.record(eventlog.PRIVATE_IN, id, len(buf.buffer))
+
+        if self.private_event_callback != None:
+            self.private_event_callback(self, buf, id, sender)
+
+        handlers = self.events.private_handlers[id]
+        if handlers != None:
+            buf.read_offset = 13
+            event = protocol.PRIVATE_EVENT_DECODERS[id](buf, sender)
+            for handler in handlers:
+                handler(self, event)
 
     def listen(self):
         while self.connected:
@@ -514,4 +1605,109 @@ class Client:
                 self.disconnect()
                 return
 
-            self.process_message(message)
+            if self.recorder != None:
+                self.recorder.inbound(self.recorder_id, message)
+            try:
+                self.process_message(message)
+            except Exception:
+                # leaves the room hub as well, so the followers get a new leader
+                self.disconnect()
+                raise
+
+# same protocol and callbacks as Client, but all connections are driven by one asyncio event loop
+# instead of a listen thread and a ping thread per client
+class AsyncClient(Client):
+    __slots__ = ("loop", "next_url")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the pool hands out blocking sockets, the event loop opens its own connections
+        if self.connection_pool != None:
+            raise ValueError("connection_pool is only supported by the threaded Client")
+        self.ws = None
+        self.loop = None
+        self.next_url = None
+
+    def start(self):
+        return asyncio.ensure_future(self.run())
+
+    async def open_connection(self, url):
+        return await aiows.connect(url, proxy_options=self.proxy_options)
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.mark_phase("start")
+        self.connected = True
+        try:
+            self.ws = await self.open_connection(self.url)
+        except Exception:
+            self.connected = False
+            raise
+
+        self.mark_phase("connect")
+        self.send_init_message()
+
+    async def run(self):
+        await self.connect()
+        await self.listen()
+
+    async def listen(self):
+        while self.connected:
+            try:
+                message = await self.ws.recv()
+            except Exception:
+                self.disconnect()
+                return
+
+            if self.recorder != None:
+                self.recorder.inbound(self.recorder_id, message)
+            try:
+                self.process_message(message)
+            except Exception:
+                self.disconnect()
+                raise
+
+            # redirect requested by process_message, reconnect before reading further
+            if self.next_url != None:
+                url, self.next_url = self.next_url, None
+                if self.metrics != None:
+                    self.metrics.count("reconnects")
+                self.ws.close()
+                try:
+                    self.ws = await self.open_connection(url)
+                except Exception:
+                    self.disconnect()
+                    return
+                self.mark_phase("switched")
+                self.send_init_message()
+
+    def switch_server(self, url):
+        self.next_url = url
+
+    def write_frame(self, frame):
+        self.ws.send_raw(frame)
+
+    def send_raw(self, frame, payload, log=""):
+        if self.logging != None:
+            self.logging.outbound(payload)
+        if self.metrics != None:
+            self.metrics.frame_out(payload)
+        if self.recorder != None:
+            self.recorder.outbound(self.recorder_id, payload)
+        try:
+            if self.connected:
+                self.ws.send_raw(frame)
+        except:
+            self.disconnect()
+
+    # timers fire on the scheduler thread, the work is done on the event loop
+    def run_timer(self, callback, args):
+        if self.connected and self.loop != None:
+            self.loop.call_soon_threadsafe(Client.run_timer_now, self, callback, args)
+
+    def on_challenge_solved(self, x, y):
+        # solver pool callbacks arrive on a pool thread, hop back to the event loop
+        if self.challenge_pool != None and self.loop != None:
+            self.loop.call_soon_threadsafe(Client.on_challenge_solved, self, x, y)
+        else:
+            Client.on_challenge_solved(self, x, y)
@@ -0,0 +1,135 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import territorialbot
+
+# Buffer against a bit by bit model of the msb first layout the game uses
+
+@pytest.fixture(params=["numpy", "lean"], autouse=True)
+def backend(request):
+    previous = territorialbot.BACKEND
+    territorialbot.set_backend(request.param)
+    yield request.param
+    territorialbot.set_backend(previous)
+
+def reference_write(data, offset, width, value):
+    for i in range(width):
+        if (value >> (width - 1 - i)) & 1:
+            bit = offset + i
+            data[bit >> 3] |= 0x80 >> (bit & 7)
+
+def reference_read(data, offset, width):
+    value = 0
+    for i in range(width):
+        bit = offset + i
+        value = (value << 1) | ((data[bit >> 3] >> (7 - (bit & 7))) & 1)
+    return value
+
+def test_write_bits_random():
+    rng = random.Random(1)
+    for _ in range(300):
+        size = rng.randint(1, 40)
+        buf = territorialbot.Buffer(size)
+        expected = bytearray(size)
+        offset = rng.randint(0, 7)
+        buf.write_offset = offset
+        while True:
+            width = rng.randint(0, 30)
+            if offset + width > size * 8:
+                break
+            value = rng.getrandbits(width + 3)
+            buf.write_bits(width, value)
+            reference_write(expected, offset, width, value & ((1 << width) - 1))
+            offset += width
+            assert buf.write_offset == offset
+        assert bytes(buf.view) == bytes(expected)
+
+def test_decode_bits_random():
+    rng = random.Random(2)
+    for _ in range(300):
+        data = bytes(rng.getrandbits(8) for _ in range(rng.randint(1, 40)))
+        buf = territorialbot.Buffer(data=data)
+        offset = rng.randint(0, 7)
+        buf.read_offset = offset
+        while True:
+            width = rng.randint(0, 30)
+            if offset + width > len(data) * 8:
+                break
+            assert buf.decode_bits(width) == reference_read(data, offset, width)
+            offset += width
+            assert buf.read_offset == offset
+
+def test_wide_fields():
+    rng = random.Random(3)
+    data = bytes(rng.getrandbits(8) for _ in range(32))
+    for width in (31, 32, 48, 64, 100):
+        for offset in range(8):
+            buf = territorialbot.Buffer(data=data)
+            buf.read_offset = offset
+            assert buf.decode_bits(width) == reference_read(data, offset, width)
+
+def test_fields_round_trip():
+    rng = random.Random(4)
+    for _ in range(200):
+        widths = [rng.randint(1, 24) for _ in range(rng.randint(1, 8))]
+        values = [rng.getrandbits(width) for width in widths]
+        offset = rng.randint(0, 7)
+        size = (offset + sum(widths) + 7) // 8
+
+        buf = territorialbot.Buffer(size)
+        buf.write_offset = offset
+        buf.write_fields(widths, values)
+        expected = bytearray(size)
+        position = offset
+        for width, value in zip(widths, values):
+            reference_write(expected, position, width, value)
+            position += width
+        assert bytes(buf.view) == bytes(expected)
+
+        buf.read_offset = offset
+        assert buf.read_fields(widths) == values
+        assert buf.read_offset == offset + sum(widths)
+
+def test_end_of_buffer():
+    buf = territorialbot.Buffer(2)
+    buf.write_bits(10, 1023)
+    buf.write_bits(6, 63)
+    with pytest.raises(IndexError):
+        buf.write_bits(1, 1)
+    assert buf.write_offset == 16
+
+    buf.read_offset = 9
+    assert buf.decode_bits(7) == 127
+    with pytest.raises(IndexError):
+        buf.decode_bits(1)
+    buf.read_offset = 9
+    with pytest.raises(IndexError):
+        buf.decode_bits(8)
+    assert buf.read_offset == 9
+
+def test_str_round_trip():
+    # strings go out as utf-16 code units, a surrogate pair is joined again on read
+    text = "böt \U0001F600"
+    data = text.encode("utf-16-be")
+    units = "".join(chr(int.from_bytes(data[i:i + 2], "big")) for i in range(0, len(data), 2))
+    buf = territorialbot.Buffer(len(data) + 1)
+    buf.write_offset = 3
+    buf.write_str(units)
+    buf.read_offset = 3
+    assert buf.read_str(len(units)) == text
+
+def test_truncated_read_str():
+    buf = territorialbot.Buffer(10)
+    buf.write_str("hello")
+    # two and a half characters left
+    truncated = territorialbot.Buffer(data=bytes(buf.view[:5]))
+    assert truncated.read_str(5) == "he???"
+
+def test_backend_storage(backend):
+    buf = territorialbot.Buffer(4)
+    assert (type(buf.buffer).__module__ == "numpy") == (backend == "numpy")
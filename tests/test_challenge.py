@@ -0,0 +1,54 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import territorialbot
+
+# the fast solver jumps the affine loop, these compare it with the loop the game runs
+
+def loop_steps(value, multiplier, modulus, steps):
+    for _ in range(steps):
+        value = 1 + value * multiplier % modulus
+    return value
+
+def test_affine_steps_random():
+    rng = random.Random(2024)
+    for _ in range(20000):
+        modulus = rng.randint(1, 1 << 20)
+        multiplier = rng.choice((0, 1, rng.randint(2, 1 << 16)))
+        # start values above the modulus too, the generators pass 1 there
+        value = rng.randint(0, 2 * modulus)
+        steps = rng.randint(0, 64)
+        assert territorialbot.affine_steps(value, multiplier, modulus, steps) == loop_steps(value, multiplier, modulus, steps), (value, multiplier, modulus, steps)
+
+@pytest.mark.parametrize("multiplier", [0, 1, 2, 16384, 65535])
+def test_affine_steps_long(multiplier):
+    rng = random.Random(multiplier)
+    for _ in range(20):
+        modulus = rng.randint(1 << 18, 1 << 20)
+        value = rng.randint(1, modulus)
+        steps = rng.randint(1000, 5000)
+        assert territorialbot.affine_steps(value, multiplier, modulus, steps) == loop_steps(value, multiplier, modulus, steps)
+
+def test_affine_steps_above_modulus():
+    assert territorialbot.affine_steps(1000, 3, 7, 1) == loop_steps(1000, 3, 7, 1)
+    assert territorialbot.affine_steps(1000, 3, 7, 0) == 1000
+
+def challenges(seed, count):
+    rng = random.Random(seed)
+    return [(rng.randint(16384, 65535), rng.randint(1 << 18, (1 << 20) - 1)) for _ in range(count)]
+
+@pytest.mark.parametrize("y1, y2", challenges(11, 8))
+def test_challenge_generator(y1, y2):
+    expected = territorialbot.ChallengeGenerator(fast=False).generate_challenge(y1, y2)
+    assert territorialbot.ChallengeGenerator(fast=True).generate_challenge(y1, y2) == expected
+    assert territorialbot.solve_challenge(y1, y2) == expected
+
+@pytest.mark.parametrize("y1, y2", challenges(51, 3))
+def test_challenge_generator_old(y1, y2):
+    expected = territorialbot.ChallengeGeneratorOld(fast=False).generate_challenge(y1, y2)
+    assert territorialbot.ChallengeGeneratorOld(fast=True).generate_challenge(y1, y2) == expected
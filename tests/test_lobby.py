@@ -0,0 +1,79 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lobby
+import protocol
+import territorialbot
+
+def lobby_frame(players):
+    return protocol.encode_lobby_update({
+        "online_bits": 14,
+        "online": [10, 20, 30, 40],
+        "battles": [{
+            "id": 0,
+            "gamemode": 1,
+            "crown": 0,
+            "mapId": 3,
+            "seed": 77,
+            "players": players,
+            "maxPlayers": 512,
+            "time": 100,
+            "clans": [],
+        }],
+    })
+
+def lobby_client(nickname, state=None):
+    client = territorialbot.Client(nickname, lobby_state=state)
+    client.connection_accepted = True
+    rooms = []
+    deltas = []
+    client.setup_callbacks(
+        lobby_update_callback=lambda client, update: rooms.append(update[0]["players"]),
+        lobby_delta_callback=lambda client, delta: deltas.append(delta),
+    )
+    return client, rooms, deltas
+
+def test_lobby_back_to_earlier_state():
+    client, rooms, deltas = lobby_client("a")
+    for players in (5, 6, 5):
+        client.process_message(lobby_frame(players))
+
+    assert rooms == [5, 6, 5]
+    assert client.lobby.battles[0]["players"] == 5
+    assert [delta.changed for delta in deltas[1:]] == [{0: {"players": (5, 6)}}, {0: {"players": (6, 5)}}]
+
+def test_lobby_same_frame_skipped():
+    client, rooms, deltas = lobby_client("a")
+    client.process_message(lobby_frame(5))
+    client.process_message(lobby_frame(5))
+    assert len(deltas) == 1
+    assert client.lobby.stats()["skipped"] == 1
+
+def test_shared_lobby_state():
+    state = lobby.LobbyState()
+    first, first_rooms, deltas = lobby_client("first", state)
+    second, second_rooms, _ = lobby_client("second", state)
+
+    first.process_message(lobby_frame(5))
+    first.process_message(lobby_frame(6))
+    # the second connection delivers the same frames late, they are not applied again
+    second.process_message(lobby_frame(5))
+    assert state.battles[0]["players"] == 6
+    second.process_message(lobby_frame(6))
+    assert state.updates == 2
+
+    # the lobby really goes back
+    first.process_message(lobby_frame(5))
+    assert state.battles[0]["players"] == 5
+    second.process_message(lobby_frame(5))
+    assert state.battles[0]["players"] == 5
+    assert state.updates == 3
+    assert [delta.changed for delta in deltas[1:]] == [{0: {"players": (5, 6)}}, {0: {"players": (6, 5)}}]
+
+    # and back again, seen first by the second connection
+    second.process_message(lobby_frame(6))
+    first.process_message(lobby_frame(6))
+    assert state.battles[0]["players"] == 6
+    assert first_rooms[-1] == second_rooms[-1] == 6